@@ -1,16 +1,106 @@
 # coding: utf-8
+"""Report on buildah call timings as written by `buildah.JSONLSink`
+
+    python agg.py run.jsonl
+    python agg.py --by-options run.jsonl
+    python agg.py --compare before.jsonl after.jsonl
+"""
 
 import sys as _sys
 import json as _json
+import argparse as _argparse
 import statistics as _stats
 
 
-data = [_json.loads(_.strip()) for _ in _sys.stdin]
+def load(path):
+    f = _sys.stdin if path == "-" else open(path, "rt")
+    with f:
+        return [_json.loads(_) for _ in f if _.strip()]
+
+
+def group_key(event, by_options):
+    if not by_options:
+        return event["subcommand"]
+    options = " ".join(sorted("--" + _.replace("_", "-") for _ in event.get("options") or {}))
+    return f"{event['subcommand']} {options}".strip()
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def aggregate(data, by_options=False):
+    groups = {}
+    for event in data:
+        groups.setdefault(group_key(event, by_options), []).append(event)
+
+    result = {}
+    for key, events in groups.items():
+        d = sorted(_["duration"] for _ in events)
+        cpu = [
+            _["user_time"] + _["system_time"]
+            for _ in events
+            if _.get("user_time") is not None
+        ]
+        rss = [_["max_rss"] for _ in events if _.get("max_rss") is not None]
+        result[key] = {
+            "count": len(d),
+            "total": sum(d),
+            "mean": _stats.mean(d),
+            "p50": percentile(d, 50),
+            "p90": percentile(d, 90),
+            "p99": percentile(d, 99),
+            "cpu": _stats.mean(cpu) if cpu else None,
+            "rss": max(rss) if rss else None,
+        }
+    return result
+
+
+def _fmt(value, spec=".4f"):
+    return "-" if value is None else format(value, spec)
+
+
+def report(stats):
+    width = max([len(_) for _ in stats] + [10])
+    print(f"{'command':<{width}} {'count':>6} {'total':>9} {'mean':>8} {'p50':>8} {'p90':>8} {'p99':>8} {'cpu':>8} {'rss KiB':>9}")
+    for key, s in sorted(stats.items(), key=lambda _: -_[1]["total"]):
+        print(
+            f"{key:<{width}} {s['count']:>6} {s['total']:>9.4f} {s['mean']:>8.4f} "
+            f"{s['p50']:>8.4f} {s['p90']:>8.4f} {s['p99']:>8.4f} "
+            f"{_fmt(s['cpu']):>8} {_fmt(s['rss'], 'd'):>9}"
+        )
+
+
+def compare(before, after):
+    keys = sorted(set(before) | set(after))
+    width = max([len(_) for _ in keys] + [10])
+    print(f"{'command':<{width}} {'count':>13} {'p50':>19} {'p90':>19} {'p99':>19} {'change':>8}")
+    for key in keys:
+        b, a = before.get(key), after.get(key)
+        if b is None or a is None:
+            print(f"{key:<{width}} only in {'after' if b is None else 'before'}")
+            continue
+        change = (a["p50"] - b["p50"]) / b["p50"] * 100 if b["p50"] else 0
+        print(
+            f"{key:<{width}} {b['count']:>6}/{a['count']:<6} "
+            + " ".join(f"{b[p]:>9.4f}/{a[p]:<9.4f}" for p in ("p50", "p90", "p99"))
+            + f" {change:>+7.1f}%"
+        )
+
+
+def main(argv=None):
+    parser = _argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("file", nargs="?", default="-", help="JSONL events, defaults to stdin")
+    parser.add_argument("--by-options", action="store_true", help="group by subcommand and option names")
+    parser.add_argument("--compare", metavar="BEFORE", help="compare against the events of an earlier run")
+    args = parser.parse_args(argv)
+
+    stats = aggregate(load(args.file), args.by_options)
+    if args.compare:
+        compare(aggregate(load(args.compare), args.by_options), stats)
+    else:
+        report(stats)
 
-cmds = {_["subcommand"] for _ in data}
 
-for cmd in cmds:
-    d = sorted([_["duration"] for _ in data if _["subcommand"] == cmd])
-    if len(d) < 2:
-        continue
-    print(f"{cmd:<10} total {sum(d):<8.4f} count {len(d):<3} mean {_stats.mean(d):.4f} median {_stats.median(d):.4f} stdev {_stats.stdev(d):.4f}")
+if __name__ == "__main__":
+    main()
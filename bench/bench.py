@@ -0,0 +1,174 @@
+# coding: utf-8
+"""Benchmark the wrapper's own overhead against bench/fake_buildah.py
+
+    python bench/bench.py
+    python bench/bench.py --latency 0.05 --images 2000
+    python bench/bench.py --json > baseline.json
+    python bench/bench.py --baseline baseline.json
+
+No container runtime is needed, the fake binary answers with canned output.
+With `--baseline`, the exit code is 1 when a workflow runs more buildah
+processes than before or its overhead per call grew beyond `--tolerance`.
+"""
+
+import os as _os
+import sys as _sys
+import json as _json
+import time as _time
+import argparse as _argparse
+
+_here = _os.path.dirname(_os.path.abspath(__file__))
+_sys.path.insert(0, _os.path.dirname(_here))
+
+import buildah as _buildah
+
+
+FAKE_BUILDAH = _os.path.join(_here, "fake_buildah.py")
+
+
+def list_images(args):
+    for image in _buildah.images():
+        image.id, image.name, image.digest, image.created
+
+
+def list_images_prefetch(args):
+    for image in _buildah.images(_prefetch=True):
+        image.id, image.name, image.digest, image.created
+
+
+def _read_attributes(container):
+    (
+        container.cmd, container.entrypoint, container.env, container.labels,
+        container.port, container.user, container.workingdir, container.arch,
+    )
+
+
+def read_attributes(args):
+    _read_attributes(_buildah.Container("bench"))
+
+
+def read_attributes_projection(args):
+    _read_attributes(_buildah.Container("bench", projection=True))
+
+
+def config_keys(args):
+    container = _buildah.Container("bench")
+    for i in range(args.keys):
+        container.env[f"KEY{i}"] = str(i)
+
+
+def config_keys_transaction(args):
+    container = _buildah.Container("bench")
+    with container.transaction():
+        for i in range(args.keys):
+            container.env[f"KEY{i}"] = str(i)
+
+
+def build(args):
+    container = _buildah.from_("alpine:3.12")
+    for i in range(args.steps):
+        container.run(["sh", "-c", f"echo {i}"])
+    container.commit("bench")
+
+
+WORKFLOWS = {
+    "list_images": list_images,
+    "list_images_prefetch": list_images_prefetch,
+    "read_attributes": read_attributes,
+    "read_attributes_projection": read_attributes_projection,
+    "config_keys": config_keys,
+    "config_keys_transaction": config_keys_transaction,
+    "build": build,
+}
+
+
+def measure(workflow, args):
+    events = []
+    hook = _buildah.add_hook(events.append)
+    try:
+        start = _time.perf_counter()
+        for _ in range(args.repeat):
+            workflow(args)
+        wall = (_time.perf_counter() - start) / args.repeat
+    finally:
+        _buildah.remove_hook(hook)
+
+    calls = len(events) / args.repeat
+    child = sum(_["duration"] for _ in events) / args.repeat
+    overhead = max(wall - child, 0)
+    return {
+        "calls": calls,
+        "wall": wall,
+        "child": child,
+        "overhead": overhead,
+        "overhead_per_call": overhead / calls if calls else 0,
+        "throughput": 1 / wall if wall else 0,
+    }
+
+
+def report(results):
+    print(f"{'workflow':<28} {'calls':>7} {'wall s':>9} {'child s':>9} {'python s':>9} {'per call ms':>12} {'runs/s':>8}")
+    for name, r in results.items():
+        print(
+            f"{name:<28} {r['calls']:>7.0f} {r['wall']:>9.4f} {r['child']:>9.4f} "
+            f"{r['overhead']:>9.4f} {r['overhead_per_call'] * 1000:>12.3f} {r['throughput']:>8.2f}"
+        )
+
+
+def check(results, baseline, tolerance):
+    failures = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if b is None:
+            continue
+        if r["calls"] > b["calls"]:
+            failures.append(f"{name}: {r['calls']:.0f} buildah calls, was {b['calls']:.0f}")
+        if r["overhead_per_call"] > b["overhead_per_call"] * (1 + tolerance):
+            failures.append(
+                f"{name}: {r['overhead_per_call'] * 1000:.3f}ms overhead per call, "
+                f"was {b['overhead_per_call'] * 1000:.3f}ms"
+            )
+    return failures
+
+
+def main(argv=None):
+    parser = _argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("workflows", nargs="*", help="any of {}, defaults to all".format(", ".join(WORKFLOWS)))
+    parser.add_argument("--images", type=int, default=200, help="images the fake lists")
+    parser.add_argument("--keys", type=int, default=30, help="config keys to set")
+    parser.add_argument("--steps", type=int, default=20, help="run steps of the build")
+    parser.add_argument("--latency", type=float, default=0, help="seconds every fake call takes")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="fail on regressions against a --json run")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed overhead growth, 0.5 = 50%%")
+    args = parser.parse_args(argv)
+    unknown = set(args.workflows) - set(WORKFLOWS)
+    if unknown:
+        parser.error("unknown workflows: {}".format(", ".join(sorted(unknown))))
+
+    _buildah.executable = FAKE_BUILDAH
+    _os.environ["FAKE_BUILDAH_LATENCY"] = str(args.latency)
+    _os.environ["FAKE_BUILDAH_IMAGES"] = str(args.images)
+
+    results = {
+        name: measure(WORKFLOWS[name], args)
+        for name in args.workflows or WORKFLOWS
+    }
+
+    if args.json:
+        print(_json.dumps(results, indent=2))
+    else:
+        report(results)
+
+    if args.baseline:
+        with open(args.baseline, "rt") as f:
+            failures = check(results, _json.load(f), args.tolerance)
+        for failure in failures:
+            print(failure, file=_sys.stderr)
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    _sys.exit(main())
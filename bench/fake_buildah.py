@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# coding: utf-8
+"""Stand-in for the buildah binary returning canned output
+
+Configured through the environment:
+
+    FAKE_BUILDAH_LATENCY  seconds every call sleeps, defaults to 0
+    FAKE_BUILDAH_IMAGES   number of rows `images` lists, defaults to 10
+    FAKE_BUILDAH_ROOT     path `mount` reports, defaults to the temp dir
+"""
+
+import os as _os
+import re as _re
+import sys as _sys
+import json as _json
+import time as _time
+import hashlib as _hashlib
+import tempfile as _tempfile
+
+
+def _id(seed):
+    return _hashlib.sha256(str(seed).encode()).hexdigest()
+
+
+CONTAINER_ID = _id("container")
+IMAGE_ID = _id("image")
+CREATED = "2020-05-29T21:19:46.363518345Z"
+
+
+def _inspect(name, type_):
+    config = {
+        "created": CREATED,
+        "architecture": "amd64",
+        "os": "linux",
+        "config": {
+            "Env": ["PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"],
+            "Cmd": ["/bin/sh"],
+            "WorkingDir": "/",
+            "User": "",
+            "Labels": {},
+        },
+        "rootfs": {"type": "layers", "diff_ids": ["sha256:" + _id("layer")]},
+    }
+    container = type_ != "image"
+    return {
+        "Type": "buildah 0.0.1",
+        "FromImage": "docker.io/library/alpine:3.12",
+        "FromImageID": IMAGE_ID,
+        "FromImageDigest": "sha256:" + _id("digest"),
+        "Config": _json.dumps(config),
+        "Manifest": "{}",
+        "Container": name if container else "",
+        "ContainerID": CONTAINER_ID if container else "",
+        "MountPoint": "",
+        "ImageAnnotations": {},
+        "ImageCreatedBy": "",
+        "OCIv1": config,
+        "Docker": config,
+        "History": [{"created": CREATED, "created_by": "/bin/sh"}],
+    }
+
+
+# JSON names of nested fields where they differ from the Go ones
+_JSON_NAMES = {
+    "Created": "created",
+    "Author": "author",
+    "Architecture": "architecture",
+    "OS": "os",
+    "Config": "config",
+    "RootFS": "rootfs",
+    "DiffIDs": "diff_ids",
+    "History": "history",
+}
+
+
+def _lookup(info, path):
+    top, *rest = path.split(".")
+    value = info.get(top)
+    for name in rest:
+        if value is None:
+            return None
+        value = value.get(_JSON_NAMES.get(name, name))
+    return value
+
+
+def _options(args):
+    # Splits `[--opt value | --flag]... positional...`, flags are the known
+    # boolean ones, everything else takes a value
+    flags = {"--json", "--quiet", "-q", "--all", "-a", "--rm"}
+    options, positional = {}, []
+    while args:
+        arg = args.pop(0)
+        if arg in flags:
+            options[arg] = True
+        elif arg.startswith("-") and args:
+            options.setdefault(arg, []).append(args.pop(0))
+        else:
+            positional.append(arg)
+    return options, positional
+
+
+def main(argv):
+    _time.sleep(float(_os.environ.get("FAKE_BUILDAH_LATENCY", 0)))
+
+    # Global options come in pairs before the subcommand
+    while argv and argv[0].startswith("-"):
+        argv = argv[2:]
+    subcommand, options, args = argv[0], *_options(argv[1:])
+
+    if subcommand == "inspect":
+        type_ = options.get("--type", ["container"])[0]
+        info = _inspect(args[0], type_)
+        if "--format" in options:
+            print(_re.sub(
+                r"\{\{with \.([\w.]+)\}\}\{\{json \.(\w+)\}\}\{\{else\}\}null\{\{end\}\}|\{\{json \.(\w+)\}\}",
+                lambda m: _json.dumps(_lookup(info, m.group(3) or m.group(1) + "." + m.group(2))),
+                options["--format"][0],
+            ))
+        else:
+            print(_json.dumps(info))
+    elif subcommand == "images":
+        print(_json.dumps([
+            {
+                "id": _id(i),
+                "names": [f"localhost/image-{i}:latest"],
+                "digest": "sha256:" + _id(("digest", i)),
+                "createdat": "2020-05-29 21:19:46.363518345 +0000 UTC",
+                "size": "5.8 MB",
+                "created": 1590787186,
+                "createdatraw": "2020-05-29T21:19:46.363518345Z",
+                "readonly": False,
+                "history": None,
+            }
+            for i in range(int(_os.environ.get("FAKE_BUILDAH_IMAGES", 10)))
+        ]))
+    elif subcommand == "containers":
+        print(_json.dumps([{
+            "id": CONTAINER_ID,
+            "builder": True,
+            "imageid": IMAGE_ID,
+            "imagename": "docker.io/library/alpine:3.12",
+            "containername": "alpine-working-container",
+        }]))
+    elif subcommand == "from":
+        with open(options["--cidfile"][0], "wt") as f:
+            f.write(CONTAINER_ID)
+    elif subcommand in ("commit", "pull"):
+        print(IMAGE_ID)
+    elif subcommand in ("copy", "add"):
+        print(_id(args))
+    elif subcommand == "mount":
+        print(_os.environ.get("FAKE_BUILDAH_ROOT", _tempfile.gettempdir()))
+    elif subcommand == "info":
+        print(_json.dumps({"host": {}, "store": {}}))
+    # config, run, rm, rmi, tag, push and umount succeed without output
+
+
+if __name__ == "__main__":
+    main(_sys.argv[1:])
@@ -1,20 +1,64 @@
 # coding: utf-8
 
 import os as _os
+import sys as _sys
+import types as _types
+import queue as _queue
+import base64 as _base64
+import functools as _functools
+import itertools as _itertools
 import time as _time
+import io as _io
 import json as _json
+import hashlib as _hashlib
+import codecs as _codecs
+import locale as _locale
+import asyncio as _asyncio
+import weakref as _weakref
+import datetime as _datetime
+import errno as _errno
+import fcntl as _fcntl
 import shlex as _shlex
+import shutil as _shutil
+import stat as _stat
+import posixpath as _posixpath
+import atexit as _atexit
+import re as _re
 import operator as _op
+import random as _random
+import threading as _threading
+import collections as _collections
+import selectors as _selectors
 import subprocess as _sp
 import logging as _logging
+import tarfile as _tarfile
 import tempfile as _tempfile
+import sqlite3 as _sqlite3
+import zlib as _zlib
+import struct as _struct
 import contextlib as _contextlib
+import concurrent.futures as _futures
+
+try:
+    import zstandard as _zstd
+except ImportError:  # Only needed for zstd compressed exports
+    _zstd = None
 
 
 _log = _logging.getLogger()
 
 global_options = {}
-#timings = open("/tmp/timings", "wt")
+# The buildah binary to run, a name looked up in $PATH or a path
+executable = "buildah"
+
+# ioctl to share the extents of a file, see ioctl_ficlone(2)
+_FICLONE = 0x40049409
+
+# The `UnshareWorker` calls are routed through, see `unshare`
+_worker = None
+
+# Callables that receive an event dict for every buildah call, see `add_hook`
+hooks = []
 
 
 class BuildahError(Exception):
@@ -25,6 +69,178 @@ class BuildahNotFound(BuildahError):
     pass
 
 
+class BuildahTransientError(BuildahError):
+    """A failure caused by other users of the storage, worth retrying"""
+
+
+class BuildahLockError(BuildahTransientError):
+    pass
+
+
+class BuildahInUseError(BuildahTransientError):
+    pass
+
+
+# Known messages of failures due to contention on the storage
+_TRANSIENT_ERRORS = [
+    (BuildahLockError, _re.compile(
+        r"resource temporarily unavailable|database is locked|acquiring (the )?lock"
+        r"|lock\b.*\b(busy|held|timed out|timeout)",
+        _re.I,
+    )),
+    # Only containers held by another process, "image is in use by a
+    # container" and the like are not going away by retrying
+    (BuildahInUseError, _re.compile(r"\bcontainer\b[^\n]*\b(is )?(in use|busy|being used)\b", _re.I)),
+]
+
+
+def _error(stderr):
+    for error, pattern in _TRANSIENT_ERRORS:
+        if stderr and pattern.search(stderr):
+            return error(stderr)
+    return BuildahError(stderr)
+
+
+def _resolved_id(info):
+    # Images have no container id, but containers do carry their image id
+    return info.get("ContainerID") or info.get("FromImageID")
+
+
+def _same_name(name, other):
+    # Image names may be given without registry or tag
+    return any(
+        name == other + suffix or name.endswith("/" + other + suffix)
+        for suffix in ("", ":latest")
+    )
+
+
+class InspectCache:
+    """Process wide cache of `inspect` results, disabled as long as `ttl` is 0
+
+    Entries are keyed by the resolved id, the names they were looked up by
+    and the name the info carries are remembered as aliases. Mutating calls
+    invalidate the affected entries.
+    """
+
+    def __init__(self, ttl=0, max_entries=512):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = _collections.OrderedDict()
+        self._aliases = {}
+        self._lock = _threading.RLock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_entries > 0
+
+    def _fresh(self, entry):
+        return entry is not None and _time.monotonic() - entry[0] < self.ttl
+
+    def get(self, name_or_id, type_=None):
+        if not self.enabled:
+            return None
+        with self._lock:
+            id_ = self._aliases.get((type_, name_or_id), name_or_id)
+            entry = self._entries.get(id_)
+            if not self._fresh(entry):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(id_)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, name_or_id, type_, info):
+        if not self.enabled:
+            return
+        id_ = _resolved_id(info)
+        # Mutations may address the object by its name instead
+        name = info.get("Container") if info.get("ContainerID") else info.get("FromImage")
+        with self._lock:
+            self._aliases[(type_, name_or_id)] = id_
+            if name:
+                self._aliases[(type_, name)] = id_
+            self._entries[id_] = (_time.monotonic(), info)
+            self._entries.move_to_end(id_)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if len(self._aliases) > 4 * self.max_entries:
+                self._aliases = {
+                    k: v for k, v in self._aliases.items() if v in self._entries
+                }
+
+    def current(self, info):
+        """Whether `info` is still what the cache holds for its id"""
+        if not self.enabled:
+            return True
+        with self._lock:
+            entry = self._entries.get(_resolved_id(info))
+            return self._fresh(entry) and entry[1] is info
+
+    def latest(self, info):
+        """The fresh entry for the id of `info`, without counting a hit or miss"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(_resolved_id(info))
+            return entry[1] if self._fresh(entry) else None
+
+    def invalidate(self, *names_or_ids, names=False):
+        """Drop the entries of `names_or_ids`, `names` also forgets all aliases
+
+        The latter is needed whenever names may have moved to other ids. Only
+        one name of an image is known, so those calls drop all images when a
+        name matches nothing.
+        """
+        with self._lock:
+            for name_or_id in names_or_ids:
+                ids = {v for (_, k), v in self._aliases.items() if _same_name(k, name_or_id)}
+                ids.update(_ for _ in self._entries if _.startswith(name_or_id))
+                if not ids and names:
+                    ids = {k for k, v in self._entries.items() if not v[1].get("ContainerID")}
+                for id_ in ids:
+                    self._entries.pop(id_, None)
+            if names:
+                self._aliases.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._aliases.clear()
+
+
+inspect_cache = InspectCache()
+
+# How many leading arguments of a subcommand name the objects it changes
+# (`None` meaning all of them) and whether names may move to other ids
+_MUTATING = {
+    "config": (1, False),
+    "copy": (1, False),
+    "add": (1, False),
+    "run": (1, False),
+    "mount": (None, False),
+    "umount": (None, False),
+    "rm": (None, False),
+    "commit": (None, True),
+    "rmi": (None, True),
+    "tag": (None, True),
+    "pull": (1, True),
+    "bud": (None, True),
+    "manifest create": (None, True),
+    "manifest rm": (None, True),
+}
+
+
+def _invalidate(subcommand, args, options):
+    if subcommand not in _MUTATING:
+        return
+    if options.get("all"):
+        return inspect_cache.clear()
+    count, names = _MUTATING[subcommand]
+    inspect_cache.invalidate(*[str(_) for _ in args[:count]], names=names)
+
+
 def _optify_key(k):
     if len(k) == 1:
         return "-{}".format(k)
@@ -58,48 +274,420 @@ def _optify(d):
     return opts
 
 
+class _Call:
+    """A single buildah invocation, shared by the sync and async APIs"""
+
+    def __init__(self, subcommand, args, kwargs):
+        special, options = _split_special(kwargs)
+        self.subcommand = subcommand
+        self.args = args
+        self.options = options
+        self.json = special.get("json", False)
+        self.list = special.get("list", False)
+        self.wrapper = special.get("wrapper")
+        self.capture_output = special.get(
+            "capture_output",
+            self.json or self.list or self.wrapper,
+        )
+
+        if not self.wrapper:
+            self.wrapper = lambda x: x
+
+        if self.json and special.get("json_flag", True):
+            options["json"] = True
+
+        self.cmd = (
+            [executable]
+            + _optify(global_options)
+            + subcommand.split()
+            + _optify(options)
+            + list(args)
+        )
+
+    def result(self, result):
+        _invalidate(self.subcommand, self.args, self.options)
+        if result.returncode != 0:
+            raise _error(result.stderr)
+
+        if self.json:
+            result = _json.loads(result.stdout)
+        elif self.capture_output:
+            result = result.stdout
+
+        if self.list:
+            # Handle "null" return string, the "containers" subcommand
+            # returns "null" instead of "[]" when there are no containers
+            return [self.wrapper(_) for _ in result or []]
+
+        if self.capture_output:
+            return self.wrapper(result)
+
+        return result
+
+
+def add_hook(hook):
+    """Register `hook` to be called with an event dict after every buildah call
+
+    The event carries the `subcommand`, `options`, `args`, `start`, the wall
+    `duration`, `user_time`, `system_time` and `max_rss` (KiB) of the child,
+    `stdout_bytes`, `stderr_bytes` and the `returncode`. Resource usage is
+    `None` for calls made through the async API.
+    """
+    hooks.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+class JSONLSink:
+    """Hook writing every event as a line of JSON to a path or file object"""
+
+    def __init__(self, target):
+        self._file = open(target, "at") if isinstance(target, str) else target
+        self._lock = _threading.Lock()
+
+    def __call__(self, event):
+        line = _json.dumps(event, default=str) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Histogram:
+    """Hook keeping the call durations per subcommand in memory"""
+
+    def __init__(self):
+        self.durations = _collections.defaultdict(list)
+        self._lock = _threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.durations[event["subcommand"]].append(event["duration"])
+
+    def percentiles(self, subcommand, *percents):
+        durations = sorted(self.durations[subcommand])
+        if not durations:
+            return [None for _ in percents]
+        return [
+            durations[min(len(durations) - 1, int(len(durations) * p / 100))]
+            for p in percents
+        ]
+
+    def summary(self):
+        with self._lock:
+            return {
+                subcommand: dict(
+                    count=len(durations),
+                    total=sum(durations),
+                    **dict(zip(("p50", "p90", "p99"), self.percentiles(subcommand, 50, 90, 99))),
+                )
+                for subcommand, durations in self.durations.items()
+            }
+
+
+def _emit(call, start, returncode, stdout_bytes, stderr_bytes, rusage=None):
+    if not hooks:
+        return
+    event = {
+        "subcommand": str(call.subcommand),
+        "options": call.options,
+        "args": [str(_) for _ in call.args],
+        "start": start,
+        "duration": _time.time() - start,
+        "user_time": rusage.ru_utime if rusage else None,
+        "system_time": rusage.ru_stime if rusage else None,
+        "max_rss": rusage.ru_maxrss if rusage else None,
+        "stdout_bytes": stdout_bytes,
+        "stderr_bytes": stderr_bytes,
+        "returncode": returncode,
+    }
+    for hook in list(hooks):
+        try:
+            hook(event)
+        except Exception:
+            _log.exception("Instrumentation hook %r failed", hook)
+
+
+def _pump(proc):
+    # Yields `(name, chunk)` from stdout and stderr until both are closed
+    with _selectors.DefaultSelector() as selector:
+        for name in ("stdout", "stderr"):
+            pipe = getattr(proc, name)
+            if pipe is not None:
+                selector.register(pipe, _selectors.EVENT_READ, name)
+        while selector.get_map():
+            for key, _ in selector.select():
+                chunk = _os.read(key.fd, 65536)
+                if chunk:
+                    yield key.data, chunk
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+
+
+def _wait(proc):
+    # Reap the child ourselves to get hold of its resource usage
+    _, status, rusage = _os.wait4(proc.pid, 0)
+    proc.returncode = _exitcode(status)
+    return rusage
+
+
+def _exitcode(status):
+    # Like `subprocess` does it, `os.waitstatus_to_exitcode` needs 3.9
+    if _os.WIFSIGNALED(status):
+        return -_os.WTERMSIG(status)
+    return _os.WEXITSTATUS(status)
+
+
+class _Process:
+    """A buildah child of this process"""
+
+    def __init__(self, cmd, capture_output):
+        self._proc = _sp.Popen(
+            cmd,
+            stdout=_sp.PIPE if capture_output else None,
+            stderr=_sp.PIPE,
+        )
+
+    @property
+    def returncode(self):
+        return self._proc.returncode
+
+    def chunks(self):
+        return _pump(self._proc)
+
+    def kill(self):
+        pipes = [_ for _ in (self._proc.stdout, self._proc.stderr) if _ is not None and not _.closed]
+        self._proc.kill()
+        for pipe in pipes:
+            pipe.close()
+
+    def wait(self):
+        return _wait(self._proc)
+
+
+def _spawn(cmd, capture_output):
+    if _worker is not None:
+        return _worker.spawn(cmd, capture_output)
+    return _Process(cmd, capture_output)
+
+
+def _log_call(call):
+    _log.debug("Running %s", " ".join([str(_).strip() for _ in call.cmd]))
+
+
 def _buildah(subcommand, *args, **kwargs):
-    special, options = _split_special(kwargs)
-    json_ = special.get("json", False)
-    json_flag = special.get("json_flag", True)
-    list_ = special.get("list", False)
-    wrapper = special.get("wrapper")
-    capture_output = special.get("capture_output", json_ or list_ or wrapper)
+    call = _Call(subcommand, args, kwargs)
+
+    _log_call(call)
+    start = _time.time()
+    process = _spawn(call.cmd, call.capture_output)
+    output = {"stdout": [], "stderr": []}
+    for name, chunk in process.chunks():
+        output[name].append(chunk)
+    rusage = process.wait()
+
+    stdout = b"".join(output["stdout"]) if call.capture_output else None
+    stderr = b"".join(output["stderr"])
+    _emit(call, start, process.returncode, len(stdout or b""), len(stderr), rusage)
+    return call.result(
+        _sp.CompletedProcess(call.cmd, process.returncode, _decode(stdout), _decode(stderr)),
+    )
+
+
+# Bytes of stderr kept for the error of streamed calls, and the longest line
+# that is buffered before it is handed out in pieces
+_STDERR_TAIL = 64 * 1024
+_MAX_LINE = 1024 * 1024
 
-    if not wrapper:
-        wrapper = lambda x: x
 
-    if json_ and json_flag:
-        options["json"] = True
+class _LineSplitter:
 
-    cmd = (
-        ["buildah"]
-        + _optify(global_options)
-        + [subcommand]
-        + _optify(options)
-        + list(args)
+    def __init__(self):
+        decoder = _codecs.getincrementaldecoder(_locale.getpreferredencoding(False))
+        self._decoder = decoder(errors="replace")
+        self._buffer = ""
+
+    def feed(self, chunk, final=False):
+        *lines, self._buffer = (self._buffer + self._decoder.decode(chunk, final)).split("\n")
+        lines = [_ + "\n" for _ in lines]
+        if self._buffer and (final or len(self._buffer) > _MAX_LINE):
+            lines.append(self._buffer)
+            self._buffer = ""
+        return lines
+
+
+def _stream(call, binary=False):
+    _log_call(call)
+    start = _time.time()
+    process = _spawn(call.cmd, True)
+    counts = {"stdout": 0, "stderr": 0}
+    splitters = {name: _LineSplitter() for name in counts}
+    tail = _collections.deque()
+    done = False
+    try:
+        for name, chunk in process.chunks():
+            counts[name] += len(chunk)
+            if name == "stderr":
+                tail.append(chunk)
+                while sum(map(len, tail)) - len(tail[0]) >= _STDERR_TAIL:
+                    tail.popleft()
+            if binary:
+                yield name, chunk
+            else:
+                for line in splitters[name].feed(chunk):
+                    yield name, line
+        if not binary:
+            for name, splitter in splitters.items():
+                for line in splitter.feed(b"", final=True):
+                    yield name, line
+        done = True
+    finally:
+        if not done:
+            # The consumer stopped early, do not leave the child behind
+            process.kill()
+        rusage = process.wait()
+
+    _emit(call, start, process.returncode, counts["stdout"], counts["stderr"], rusage)
+    call.result(
+        _sp.CompletedProcess(call.cmd, process.returncode, None, _decode(b"".join(tail)[-_STDERR_TAIL:])),
+    )
+
+
+def _buildah_stream(subcommand, *args, **kwargs):
+    """Like `_buildah` but hands out the output as it arrives
+
+    Without `_sink`, returns an iterator of `("stdout" | "stderr", data)`
+    with `data` being lines, or byte chunks if `_binary` is set. Otherwise
+    stdout is written to `_sink` and stderr to `_stderr_sink` (either being
+    file objects or callables) and `None` is returned once the call is done.
+    Undecodable bytes are replaced in line mode. Failed calls raise
+    `BuildahError` with the tail of stderr at the end.
+    """
+    special, _ = _split_special(kwargs)
+    output = _stream(_Call(subcommand, args, kwargs), special.get("binary", False))
+
+    if special.get("sink") is None:
+        return output
+
+    sinks = {"stdout": special["sink"], "stderr": special.get("stderr_sink")}
+    sinks = {k: getattr(v, "write", v) for k, v in sinks.items() if v is not None}
+    for name, data in output:
+        if name in sinks:
+            sinks[name](data)
+
+
+# Upper bound of buildah processes the async API runs at the same time,
+# use `set_async_limit` to change it
+async_limit = _os.cpu_count() or 4
+_async_semaphores = _weakref.WeakKeyDictionary()
+
+
+def set_async_limit(limit):
+    global async_limit
+    async_limit = limit
+    # Calls that already wait on the old semaphores keep using them
+    _async_semaphores.clear()
+
+
+def _async_semaphore():
+    loop = _asyncio.get_running_loop()
+    if loop not in _async_semaphores:
+        _async_semaphores[loop] = _asyncio.Semaphore(async_limit)
+    return _async_semaphores[loop]
+
+
+def _decode(data):
+    if data is None:
+        return None
+    return data.decode(_locale.getpreferredencoding(False))
+
+
+async def _abuildah(subcommand, *args, **kwargs):
+    if _worker is not None:
+        # The worker is driven through pipes and threads already
+        async with _async_semaphore():
+            return await _asyncio.get_running_loop().run_in_executor(
+                None,
+                _functools.partial(_buildah, subcommand, *args, **kwargs),
+            )
+
+    call = _Call(subcommand, args, kwargs)
+
+    _log_call(call)
+    start = _time.time()
+    async with _async_semaphore():
+        proc = await _asyncio.create_subprocess_exec(
+            *call.cmd,
+            stdout=_sp.PIPE if call.capture_output else None,
+            stderr=_sp.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
+    _emit(call, start, proc.returncode, len(stdout or b""), len(stderr or b""))
+    return call.result(
+        _sp.CompletedProcess(call.cmd, proc.returncode, _decode(stdout), _decode(stderr)),
     )
 
-    print("Running {}".format(" ".join([str(_).strip() for _ in cmd])))
-    t_start = _time.time()
-    result = _sp.run(cmd, stdout=_sp.PIPE if capture_output else None, stderr=_sp.PIPE, text=True)
-    if result.returncode != 0:
-        raise BuildahError(result.stderr)
-    #timings.write(_json.dumps({"subcommand": str(subcommand), "options": options, "args": [str(_) for _ in args], "duration": _time.time() - t_start}) + "\n")
-    if json_:
-        result = _json.loads(result.stdout)
-    elif capture_output:
-        result = result.stdout
 
-    if list_:
-        # Handle "null" return string, the "containers" subcommand
-        # returns "null" instead of "[]" when there are no containers
-        return [wrapper(_) for _ in result or []]
+# Pending `config` writes of containers currently inside a `transaction()`,
+# keyed by container id
+_config_batches = {}
+# Recorders by their made up ids, `config` calls for them are recorded
+_recordings = {}
+
+
+class _ConfigBatch:
+
+    def __init__(self):
+        self.options = {}
+        self.members = {}
+
+    def set(self, option, value):
+        if option in self.members:
+            for member in value:
+                self.toggle(option, member, True)
+        elif isinstance(value, dict):
+            pending = self.options.setdefault(option, {})
+            for k, v in value.items():
+                # A key that was removed and is now set again gets appended
+                # by buildah, so move it to the end to keep that order
+                if v is not None and k in pending and pending[k] is None:
+                    del pending[k]
+                pending[k] = v
+        else:
+            self.options[option] = value
+
+    def toggle(self, option, value, present):
+        if option not in self.members:
+            self.members[option] = dict.fromkeys(self.options.pop(option, ()), True)
+        self.members[option].pop(value, None)
+        self.members[option][value] = present
+
+    def merged(self):
+        options = dict(self.options)
+        for option, members in self.members.items():
+            options[option] = [v if present else f"{v}-" for v, present in members.items()]
+        return options
+
 
-    if capture_output:
-        return wrapper(result)
+def _configure(name_or_id, **options):
+    batch = _config_batches.get(name_or_id)
+    if batch is None:
+        return config(name_or_id, **options)
+    for option, value in options.items():
+        batch.set(option, value)
 
-    return result
+
+def _configure_member(name_or_id, option, value, present):
+    batch = _config_batches.get(name_or_id)
+    if batch is None:
+        return config(name_or_id, **{option: value if present else f"{value}-"})
+    batch.toggle(option, value, present)
 
 
 class ConfigurableSet(set):
@@ -110,11 +698,11 @@ class ConfigurableSet(set):
         self._name_or_id = name_or_id
 
     def add(self, value):
-        config(self._name_or_id, **{self._option: value})
+        _configure_member(self._name_or_id, self._option, value, True)
         return super().add(value)
 
     def discard(self, value):
-        config(self._name_or_id, **{self._option: f"{value}-"})
+        _configure_member(self._name_or_id, self._option, value, False)
         return super().discard(value)
 
 
@@ -126,23 +714,50 @@ class ConfigurableMapping(dict):
         self._option = option
 
     def __setitem__(self, name, value):
-        config(self._name_or_id, **{self._option: {name: value}})
+        _configure(self._name_or_id, **{self._option: {name: value}})
         return super().__setitem__(name, value)
 
     def __delitem__(self, name):
-        config(self._name_or_id, **{self._option: {name: None}})
+        _configure(self._name_or_id, **{self._option: {name: None}})
         return super().__delitem__(name)
 
 
+def _parse_timestamp(value):
+    # Go emits nanoseconds, which `fromisoformat` does not accept
+    date, tz = _re.match(r"(.*?T[\d:]+)(?:\.\d+)?(Z|[+-][\d:]+)?$", value).groups()
+    if tz in (None, "Z"):
+        tz = "+00:00"
+    return int(_datetime.datetime.fromisoformat(date + tz).timestamp())
+
+
 class Info:
 
-    def __init__(self, name, reader):
+    def __init__(self, name, reader, listing=None, fields=None):
         self.name = name
         self._reader = reader
+        self._listing = listing
+        # Inspect fields the reader needs as template paths like
+        # "OCIv1.Config.Cmd", used for projections
+        self._fields = fields
+
+    def _read(self, obj):
+        # Rows from `images`/`containers` already carry some of the fields,
+        # prefer them as long as we did not have to inspect anyway
+        if self._listing is not None and obj._listing and obj._info is None:
+            try:
+                return self._listing(obj._listing)
+            except (KeyError, IndexError, TypeError):
+                pass
+        if obj._projection and obj._info is None and self._fields:
+            return self._reader(obj._partial())
+        return self._reader(obj.info)
 
     def __get__(self, obj, objtype):
+        if obj is None:
+            return self
+        obj._sync()
         if self.name not in obj._cache:
-            obj._cache[self.name] = self._reader(obj.info)
+            obj._cache[self.name] = self._read(obj)
         return obj._cache[self.name]
 
 
@@ -150,32 +765,141 @@ class Configurable(Info):
 
     def __set__(self, obj, val):
         obj._cache[self.name] = val
-        config(obj.id, **{self.name: val})
+        _configure(obj.id, **{self.name: val})
+
+
+@_functools.lru_cache(maxsize=None)
+def _projected_fields(cls):
+    # The fields all `Info` descriptors of `cls` need, projections fetch
+    # them together
+    fields = []
+    for klass in reversed(cls.__mro__):
+        for attr in vars(klass).values():
+            if isinstance(attr, Info) and attr._fields:
+                fields += attr._fields
+    return tuple(dict.fromkeys(fields))
 
 
 class Inspectable:
 
     _TYPE = None
+    # Names of the descriptors kept when the shared inspect cache moves on
+    _IDENTITY = ("id",)
 
-    def __init__(self, name_or_id):
+    def __init__(self, name_or_id, prefetch=True, listing=None, projection=False):
         self._name_or_id = name_or_id
-        self.info = None
+        self._info = None
+        self._listing = listing
+        self._projection = projection
+        # Partial info the descriptors read from in projection mode
+        self._projected = None
         self._cache = dict()
-        self.refresh()
+        if prefetch and not projection:
+            # Goes through the shared cache, only `refresh()` bypasses it
+            self._info = self.inspect()
+
+    def _sync(self):
+        # Forget what we know once the shared inspect cache moved on, unless
+        # a transaction still has to write our local changes
+        if self._info is None or inspect_cache.current(self._info):
+            return
+        if _resolved_id(self._info) in _config_batches:
+            return
+        self._info = None
+        self._forget_config()
+
+    def _forget_config(self):
+        # What identifies the object does not change with its config, so
+        # reading it again does not need another inspect
+        self._cache = {k: v for k, v in self._cache.items() if k in self._IDENTITY}
+
+    @property
+    def info(self):
+        self._sync()
+        if self._info is None:
+            self._info = self.inspect()
+        return self._info
 
     def inspect(self):
         return inspect(self._name_or_id, type=self._TYPE)
 
+    def project(self, fields):
+        return inspect(self._name_or_id, type=self._TYPE, _fields=fields)
+
+    def _partial(self):
+        # A full info the shared cache has is as good as a projection
+        if self._projected is None:
+            self._projected = (
+                inspect_cache.get(self._name_or_id, self._TYPE)
+                or self.project(_projected_fields(type(self)))
+            )
+        return self._projected
+
     def refresh(self):
-        self.info = self.inspect()
+        if self._projection:
+            # Attributes are projected again on the next access
+            self._info = None
+            self._projected = None
+            self._cache.clear()
+        else:
+            inspect_cache.invalidate(self._name_or_id)
+            self._info = self.inspect()
+            self._projected = None
+            self._cache.clear()
+
+    @staticmethod
+    def refresh_all(objs, max_workers=None):
+        """Refresh many objects concurrently, returns the ones that could not be inspected"""
+        by_type = {}
+        for obj in objs:
+            by_type.setdefault(obj._TYPE, []).append(obj)
+
+        missing = []
+        for type_, group in by_type.items():
+            inspect_cache.invalidate(*[_._name_or_id for _ in group])
+            infos = inspect_many(
+                [_._name_or_id for _ in group],
+                max_workers=max_workers,
+                type=type_,
+            )
+            for obj in group:
+                info = infos[obj._name_or_id]
+                if isinstance(info, BuildahError):
+                    missing.append(obj)
+                else:
+                    obj._info = info
+                    obj._projected = None
+                    obj._cache.clear()
+        return missing
 
 
 class Image(Inspectable):
 
     _TYPE = "image"
-    id = Info("id", _op.itemgetter("FromImageID"))
-    name = Info("name", _op.itemgetter("FromImage"))
-    digest = Info("digest", _op.itemgetter("FromImageDigest"))
+    id = Info(
+        "id",
+        _op.itemgetter("FromImageID"),
+        listing=_op.itemgetter("id"),
+        fields=("FromImageID",),
+    )
+    name = Info(
+        "name",
+        _op.itemgetter("FromImage"),
+        listing=lambda x: x["names"][0],
+        fields=("FromImage",),
+    )
+    digest = Info(
+        "digest",
+        _op.itemgetter("FromImageDigest"),
+        listing=_op.itemgetter("digest"),
+        fields=("FromImageDigest",),
+    )
+    created = Info(
+        "created",
+        lambda x: _parse_timestamp(x["OCIv1"]["created"]),
+        listing=_op.itemgetter("created"),
+        fields=("OCIv1.Created",),
+    )
 
     def rm(self):
         return rmi(self.id)
@@ -190,28 +914,565 @@ class Image(Inspectable):
         return tag(self.id, *aliases)
 
 
+class MountManager:
+    """Keeps containers mounted between uses of `Container.mount()`
+
+    Mounts are reference counted. Once the last user releases one, it stays
+    mounted for `idle_timeout` seconds, then it is umounted together with all
+    other expired ones in a single `umount` call. Whatever is still mounted
+    gets umounted at interpreter exit.
+
+    The lock only guards the bookkeeping, `mount` and `umount` run outside of
+    it. Callers for a container that is being mounted or umounted wait for
+    that to finish.
+    """
+
+    def __init__(self, idle_timeout=10):
+        self.idle_timeout = idle_timeout
+        self._lock = _threading.RLock()
+        # container id -> [mount point, references, monotonic time of release]
+        self._mounts = {}
+        # container id -> future done once its mount or umount finished
+        self._pending = {}
+        self._timer = None
+
+    def _resolve(self, name_or_id):
+        # Entries are keyed by full container ids, names and id prefixes
+        # are looked up
+        with self._lock:
+            if name_or_id in self._mounts:
+                return name_or_id
+            matches = [_ for _ in self._mounts if _.startswith(name_or_id)]
+            if len(matches) == 1:
+                return matches[0]
+        if _FULL_ID.match(name_or_id):
+            return name_or_id
+        return inspect(name_or_id, type="container")["ContainerID"]
+
+    def acquire(self, name_or_id, **options):
+        container_id = self._resolve(name_or_id)
+        while True:
+            with self._lock:
+                pending = self._pending.get(container_id)
+                if pending is None:
+                    entry = self._mounts.get(container_id)
+                    if entry is not None:
+                        entry[1] += 1
+                        return entry[0]
+                    pending = self._pending[container_id] = _futures.Future()
+                    break
+            _futures.wait([pending])
+
+        try:
+            path = list(mount(container_id, **options).values())[0]
+            with self._lock:
+                self._mounts[container_id] = [path, 1, None]
+            return path
+        finally:
+            self._settle([container_id], pending)
+
+    def release(self, name_or_id):
+        container_id = self._resolve(name_or_id)
+        with self._lock:
+            entry = self._mounts.get(container_id)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            entry[2] = _time.monotonic()
+            if self.idle_timeout > 0:
+                self._schedule(self.idle_timeout)
+                return
+            pending = self._take([container_id])
+        self._umount([container_id], pending)
+
+    def _schedule(self, delay):
+        if self._timer is None:
+            self._timer = _threading.Timer(delay, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _idle(self):
+        return {k: v[2] for k, v in self._mounts.items() if v[1] == 0}
+
+    def _expire(self):
+        with self._lock:
+            self._timer = None
+            now = _time.monotonic()
+            idle = self._idle()
+            expired = [k for k, v in idle.items() if now - v >= self.idle_timeout]
+            pending = self._take(expired)
+            remaining = [self.idle_timeout - (now - v) for v in idle.values() if now - v < self.idle_timeout]
+            if remaining:
+                self._schedule(min(remaining))
+        self._umount(expired, pending)
+
+    def _take(self, container_ids):
+        # Called with the lock held, the entries are gone right away and
+        # `acquire()` waits on the returned future until they are umounted
+        pending = _futures.Future()
+        for container_id in container_ids:
+            del self._mounts[container_id]
+            self._pending[container_id] = pending
+        return pending
+
+    def _settle(self, container_ids, pending):
+        with self._lock:
+            for container_id in container_ids:
+                if self._pending.get(container_id) is pending:
+                    del self._pending[container_id]
+        pending.set_result(None)
+
+    def _umount(self, container_ids, pending):
+        if not container_ids:
+            return
+        try:
+            # Not `umount()`, which would make us forget them all over again
+            _buildah("umount", *container_ids, _capture_output=True)
+        except BuildahError:
+            _log.warning("Could not umount %s", ", ".join(container_ids))
+        finally:
+            self._settle(container_ids, pending)
+
+    def forget(self, name_or_id):
+        """Stop tracking `name_or_id`, e.g. because `rm` or `umount` did away with its mount"""
+        with self._lock:
+            if not self._mounts:
+                return
+        try:
+            container_id = self._resolve(name_or_id)
+        except BuildahError:
+            return
+        with self._lock:
+            self._mounts.pop(container_id, None)
+
+    def forget_all(self):
+        """Stop tracking any mount, e.g. after `umount(all=True)`"""
+        with self._lock:
+            self._mounts.clear()
+
+    def flush(self):
+        """Umount all idle containers right away"""
+        with self._lock:
+            idle = list(self._idle())
+            pending = self._take(idle)
+        self._umount(idle, pending)
+
+    def close(self):
+        """Umount everything, whether still in use or not"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            mounted = list(self._mounts)
+            pending = self._take(mounted)
+        self._umount(mounted, pending)
+
+
+# Full container ids, anything else may be a name or a prefix
+_FULL_ID = _re.compile(r"[0-9a-f]{64}$")
+
+mount_manager = MountManager()
+_atexit.register(mount_manager.close)
+
+
+def _resolve(root, path, follow=True):
+    # Resolve `path` below the mounted `root` like the kernel would inside
+    # the container, absolute symlinks must not lead out to the host
+    parts = [_ for _ in path.split("/") if _ not in ("", ".")]
+    resolved = []
+    links = 0
+    while parts:
+        part = parts.pop(0)
+        if part == "..":
+            if resolved:
+                resolved.pop()
+            continue
+        candidate = _os.path.join(root, *resolved, part)
+        if (parts or follow) and _os.path.islink(candidate):
+            links += 1
+            if links > 40:
+                raise OSError(_errno.ELOOP, "Too many levels of symbolic links", path)
+            target = _os.readlink(candidate)
+            if target.startswith("/"):
+                resolved = []
+            parts = [_ for _ in target.split("/") if _ not in ("", ".")] + parts
+            continue
+        resolved.append(part)
+    return _os.path.join(root, *resolved)
+
+
+def _copy_file(source, destination):
+    # Share extents if the filesystem supports it, let the kernel copy if
+    # it does not and only then copy through userspace
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        try:
+            _fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        size = _os.fstat(src.fileno()).st_size
+        try:
+            while size > 0:
+                copied = _os.copy_file_range(src.fileno(), dst.fileno(), size)
+                if not copied:
+                    break
+                size -= copied
+            return
+        except (AttributeError, OSError):
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+        _shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+class ContainerFS:
+    """Files of a container, accessed through its mount point
+
+    When the container can not be mounted (rootless outside of `buildah
+    unshare`), operations fall back to `run`, `copy` and `add`. Everything
+    goes through the module level functions, so this blocks for an
+    `AsyncContainer` as well.
+    """
+
+    def __init__(self, container):
+        self._container = container
+        self._mountable = True
+
+    @_contextlib.contextmanager
+    def _root(self):
+        if not self._mountable or _worker is not None:
+            yield None
+            return
+        container_id = self._container.id
+        try:
+            root = mount_manager.acquire(container_id)
+        except BuildahError:
+            _log.info("Could not mount %s, falling back to run", container_id)
+            self._mountable = False
+            yield None
+            return
+        try:
+            yield root
+        finally:
+            mount_manager.release(container_id)
+
+    def _run(self, cmd, **options):
+        return run(self._container.id, cmd, _capture_output=True, **options)
+
+    def read_bytes(self, path):
+        with self._root() as root:
+            if root is not None:
+                with open(_resolve(root, path), "rb") as f:
+                    return f.read()
+        return b"".join(
+            data
+            for name, data in run(self._container.id, ["cat", path], _stream=True, _binary=True)
+            if name == "stdout"
+        )
+
+    def read_text(self, path, encoding=None):
+        return self.read_bytes(path).decode(encoding or _locale.getpreferredencoding(False))
+
+    def write_bytes(self, path, data, mode=None):
+        with self._root() as root:
+            if root is not None:
+                target = _resolve(root, path)
+                with open(target, "wb") as f:
+                    f.write(data)
+                if mode is not None:
+                    _os.chmod(target, mode)
+                return
+        with _files_tar({path: (data, 0o644 if mode is None else mode, 0, 0)}) as tar:
+            add(self._container.id, tar, "/")
+
+    def write_text(self, path, text, encoding=None, mode=None):
+        return self.write_bytes(path, text.encode(encoding or _locale.getpreferredencoding(False)), mode)
+
+    def exists(self, path):
+        with self._root() as root:
+            if root is not None:
+                # Like `test -e`, a dangling symlink does not exist
+                try:
+                    return _os.path.exists(_resolve(root, path))
+                except OSError:
+                    return False
+        try:
+            self._run(["test", "-e", path])
+        except BuildahError:
+            return False
+        return True
+
+    def stat(self, path):
+        with self._root() as root:
+            if root is not None:
+                return _os.stat(_resolve(root, path))
+        fields = self._run(["stat", "-L", "-c", "%f %i %d %h %u %g %s %X %Y %Z", path]).split()
+        return _os.stat_result([int(fields[0], 16)] + [int(_) for _ in fields[1:]])
+
+    def listdir(self, path="/"):
+        with self._root() as root:
+            if root is not None:
+                return _os.listdir(_resolve(root, path))
+        return self._run(["ls", "-1A", path]).splitlines()
+
+    def walk(self, top="/"):
+        """Like `os.walk`, yielding container paths, symlinks are not followed"""
+        with self._root() as root:
+            if root is not None:
+                base = _resolve(root, top)
+                for dirpath, dirnames, filenames in _os.walk(base):
+                    relpath = _os.path.relpath(dirpath, base)
+                    path = top if relpath == "." else _os.path.join(top, relpath)
+                    yield path, dirnames, filenames
+                return
+
+        # One `find` for the whole tree, then put it together like `os.walk`
+        output = self._run([
+            "sh", "-c",
+            'find "$1" -mindepth 1 -type d | sed "s/^/d /"; find "$1" -mindepth 1 ! -type d | sed "s/^/f /"',
+            "sh", top,
+        ])
+        tree = {top: ([], [])}
+        for line in output.splitlines():
+            kind, path = line.split(" ", 1)
+            parent, name = _os.path.split(path)
+            tree.setdefault(parent, ([], []))[0 if kind == "d" else 1].append(name)
+            if kind == "d":
+                tree.setdefault(path, ([], []))
+
+        def walk(path):
+            dirnames, filenames = tree.get(path, ([], []))
+            yield path, dirnames, filenames
+            for name in list(dirnames):
+                yield from walk(_os.path.join(path, name))
+
+        yield from walk(top)
+
+    @_contextlib.contextmanager
+    def open(self, path, mode="r", **kwargs):
+        """Context manager around `open` of a container path
+
+        Without a mount, the contents are buffered in memory and written
+        back when the block exits.
+        """
+        with self._root() as root:
+            if root is not None:
+                with open(_resolve(root, path), mode, **kwargs) as f:
+                    yield f
+                return
+
+        writing = any(_ in mode for _ in "wax+")
+        contents = b""
+        if not mode.startswith(("w", "x")) and ("r" in mode or self.exists(path)):
+            contents = self.read_bytes(path)
+        buffer = _io.BytesIO(contents)
+        if "a" in mode:
+            buffer.seek(0, _os.SEEK_END)
+        f = buffer if "b" in mode else _io.TextIOWrapper(buffer, **kwargs)
+        yield f
+        f.flush()
+        if writing:
+            self.write_bytes(path, buffer.getvalue())
+
+    def copy_in(self, source, path):
+        """Copy the host file `source` into the container, sharing extents if possible"""
+        with self._root() as root:
+            if root is not None:
+                target = _resolve(root, path)
+                _copy_file(source, target)
+                _shutil.copymode(source, target)
+                return
+        copy(self._container.id, source, path)
+
+    def copy_out(self, path, destination):
+        """Copy the container file `path` to `destination` on the host"""
+        with self._root() as root:
+            if root is not None:
+                source = _resolve(root, path)
+                _copy_file(source, destination)
+                _shutil.copymode(source, destination)
+                return
+        with open(destination, "wb") as f:
+            run(self._container.id, ["cat", path], _sink=f, _binary=True)
+
+    def _manifest_path(self, destination):
+        key = "{}\0{}".format(self._container.id, _posixpath.normpath(destination))
+        return _os.path.join(_cache_dir(), "sync", _hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def sync(self, source, destination, full=False):
+        """Make `destination` mirror the host directory `source`
+
+        Only what changed since the last sync of this container and
+        destination is transferred, files with the same size and mtime are
+        taken as unchanged, otherwise their digest decides. The manifest
+        is kept in the cache directory, `full` ignores it. Returns counts of
+        the files `added`, `changed`, `deleted` and `skipped`, the `bytes`
+        transferred and `skipped_bytes`.
+        """
+        start = _time.time()
+        path = self._manifest_path(destination)
+        previous = {}
+        if not full:
+            try:
+                with open(path, "rt") as f:
+                    previous = _json.load(f)
+            except FileNotFoundError:
+                pass
+
+        current, transfer = {}, []
+        report = dict(added=0, changed=0, deleted=0, skipped=0, bytes=0, skipped_bytes=0)
+        for root, dirs, files in _os.walk(source):
+            dirs.sort()
+            for name in sorted(dirs) + sorted(files):
+                full_path = _os.path.join(root, name)
+                relative = _os.path.relpath(full_path, source)
+                st = _os.lstat(full_path)
+                if _stat.S_ISLNK(st.st_mode):
+                    kind, digest = "l", _os.readlink(full_path)
+                elif _stat.S_ISDIR(st.st_mode):
+                    kind, digest = "d", None
+                elif _stat.S_ISREG(st.st_mode):
+                    kind, digest = "f", None
+                else:
+                    continue
+
+                old = previous.get(relative)
+                if kind == "f":
+                    if old and old[:3] == ["f", st.st_size, st.st_mtime_ns]:
+                        digest = old[3]
+                    else:
+                        digest = _digest_path(full_path)
+                entry = current[relative] = [kind, st.st_size, st.st_mtime_ns, digest]
+
+                if old is not None and old[0] == kind and old[3] == digest:
+                    if kind != "d":
+                        report["skipped"] += 1
+                        report["skipped_bytes"] += st.st_size if kind == "f" else 0
+                    continue
+                if kind != "d":
+                    report["changed" if old is not None else "added"] += 1
+                    report["bytes"] += st.st_size if kind == "f" else 0
+                transfer.append((relative, full_path, entry))
+
+        # Deepest first, so directories are empty by the time they go
+        deleted = sorted(set(previous) - set(current), reverse=True)
+        report["deleted"] = sum(previous[_][0] != "d" for _ in deleted)
+
+        with self._root() as root:
+            if root is not None:
+                self._sync_mounted(root, destination, transfer, deleted)
+            else:
+                self._sync_fallback(destination, transfer, deleted)
+
+        _os.makedirs(_os.path.dirname(path), exist_ok=True)
+        with _tempfile.NamedTemporaryFile("wt", dir=_os.path.dirname(path), delete=False) as f:
+            _json.dump(current, f)
+        _os.replace(f.name, path)
+        report["duration"] = _time.time() - start
+        return report
+
+    def _sync_mounted(self, root, destination, transfer, deleted):
+        for relative in deleted:
+            target = _resolve(root, _posixpath.join(destination, relative), follow=False)
+            if _os.path.isdir(target) and not _os.path.islink(target):
+                _shutil.rmtree(target, ignore_errors=True)
+            elif _os.path.lexists(target):
+                _os.unlink(target)
+
+        _os.makedirs(_resolve(root, destination), exist_ok=True)
+        for relative, source, (kind, _, mtime_ns, _) in transfer:
+            target = _resolve(root, _posixpath.join(destination, relative), follow=False)
+            if kind == "d":
+                if _os.path.islink(target) or (_os.path.lexists(target) and not _os.path.isdir(target)):
+                    _os.unlink(target)
+                _os.makedirs(target, exist_ok=True)
+                _shutil.copymode(source, target)
+                continue
+            if _os.path.isdir(target) and not _os.path.islink(target):
+                _shutil.rmtree(target)
+            elif _os.path.lexists(target):
+                _os.unlink(target)
+            if kind == "l":
+                _os.symlink(_os.readlink(source), target)
+            else:
+                _copy_file(source, target)
+                _shutil.copymode(source, target)
+                _os.utime(target, ns=(mtime_ns, mtime_ns))
+
+    def _sync_fallback(self, destination, transfer, deleted):
+        if deleted:
+            self._run(["rm", "-rf", "--"] + [_posixpath.join(destination, _) for _ in deleted])
+        if not transfer:
+            return
+
+        def owned_by_root(info):
+            info.uid = info.gid = 0
+            info.uname = info.gname = ""
+            return info
+
+        with _tempfile.NamedTemporaryFile(suffix=".tar") as f:
+            with _tarfile.open(fileobj=f, mode="w") as tar:
+                for relative, source, _ in transfer:
+                    tar.add(source, arcname=relative, recursive=False, filter=owned_by_root)
+            f.flush()
+            add(self._container.id, f.name, destination)
+
+
 class Container(Inspectable):
 
     _TYPE = "container"
+    _IDENTITY = ("id", "name", "imageid")
     _config = None
+    _fs = None
 
-    id = Info("id", lambda x: x["ContainerID"])
-    name = Info("name", lambda x: x["Container"])
-    annotations = Configurable("annotation", _op.itemgetter("ImageAnnotations"))
-    cmd = Configurable("cmd", lambda x: x["OCIv1"]["config"].get("Cmd", []) or [])
+    id = Info(
+        "id",
+        lambda x: x["ContainerID"],
+        listing=_op.itemgetter("id"),
+        fields=("ContainerID",),
+    )
+    name = Info(
+        "name",
+        lambda x: x["Container"],
+        listing=_op.itemgetter("containername"),
+        fields=("Container",),
+    )
+    annotations = Configurable(
+        "annotation",
+        _op.itemgetter("ImageAnnotations"),
+        fields=("ImageAnnotations",),
+    )
+    cmd = Configurable(
+        "cmd",
+        lambda x: x["OCIv1"]["config"].get("Cmd", []) or [],
+        fields=("OCIv1.Config.Cmd",),
+    )
     entrypoint = Configurable(
         "entrypoint",
         lambda x: x["OCIv1"]["config"].get("Entrypoint", []) or [],
+        fields=("OCIv1.Config.Entrypoint",),
+    )
+    port = Configurable(
+        "port",
+        lambda x: list((x["OCIv1"]["config"].get("ExposedPorts") or {}).keys()),
+        fields=("OCIv1.Config.ExposedPorts",),
+    )
+    imageid = Info(
+        "imageid",
+        _op.itemgetter("FromImageID"),
+        listing=_op.itemgetter("imageid"),
+        fields=("FromImageID",),
     )
-    port = Configurable("port", lambda x: list(x["OCIv1"]["config"].get("ExposedPorts", {}).keys()))
-    imageid = Info("imageid", _op.itemgetter("FromImageID"))
     env = Configurable(
         "env",
         lambda x: ConfigurableMapping(
             x["ContainerID"],
             "env",
-            dict(_.split("=", 1) for _ in x["OCIv1"]["config"].get("Env", [])),
+            dict(_.split("=", 1) for _ in x["OCIv1"]["config"].get("Env") or []),
         ),
+        fields=("ContainerID", "OCIv1.Config.Env"),
     )
     labels = Configurable(
         "label",
@@ -220,12 +1481,23 @@ class Container(Inspectable):
             "label",
             x["OCIv1"]["config"].get("Labels", {}) or {},
         ),
+        fields=("ContainerID", "OCIv1.Config.Labels"),
     )
-    workingdir = Configurable("workingdir", lambda x: x["Config"]["config"]["WorkingDir"])
-    user = Configurable("user", lambda x: x["Config"]["config"]["User"])
-    arch = Configurable("arch", lambda x: x["Config"]["architecture"])
-    os = Configurable("os", lambda x: x["Config"]["os"])
-    author = Configurable("author", lambda x: x["OCIv1"].get("author"))
+    # Read from `OCIv1` rather than the JSON encoded `Config`, which
+    # templates cannot reach into and `config` writes do not update
+    workingdir = Configurable(
+        "workingdir",
+        lambda x: x["OCIv1"]["config"].get("WorkingDir") or "",
+        fields=("OCIv1.Config.WorkingDir",),
+    )
+    user = Configurable(
+        "user",
+        lambda x: x["OCIv1"]["config"].get("User") or "",
+        fields=("OCIv1.Config.User",),
+    )
+    arch = Configurable("arch", lambda x: x["OCIv1"]["architecture"], fields=("OCIv1.Architecture",))
+    os = Configurable("os", lambda x: x["OCIv1"]["os"], fields=("OCIv1.OS",))
+    author = Configurable("author", lambda x: x["OCIv1"].get("author"), fields=("OCIv1.Author",))
     volumes = Configurable(
         "volume",
         lambda x: ConfigurableSet(
@@ -233,18 +1505,60 @@ class Container(Inspectable):
             "volume", 
             (x["OCIv1"]["config"].get("Volumes") or {}).keys(),
         ),
+        fields=("ContainerID", "OCIv1.Config.Volumes"),
+    )
+    # Only the Docker format knows ONBUILD
+    onbuild = Configurable(
+        "onbuild",
+        lambda x: (x["Docker"].get("config") or {}).get("OnBuild"),
+        fields=("Docker.Config.OnBuild",),
+    )
+    stop_signal = Configurable(
+        "stop_signal",
+        lambda x: x["OCIv1"]["config"].get("StopSignal"),
+        fields=("OCIv1.Config.StopSignal",),
     )
-    onbuild = Configurable("onbuild", lambda x: x["Config"].get("OnBuild"))
-    stop_signal = Configurable("stop_signal", lambda x: x["OCIv1"]["config"].get("StopSignal"))
 
-    def __init__(self, name_or_id=None, base=None):
+    def __init__(self, name_or_id=None, base=None, prefetch=True, listing=None, projection=False):
         if name_or_id is None and base is None:
             raise RuntimeError("You need to either pass an existing image name or a base image to create a new container from")
 
         if base is not None:
             name_or_id = from_(base, _wrapper=str, name=name_or_id)
 
-        super().__init__(name_or_id)
+        super().__init__(name_or_id, prefetch=prefetch, listing=listing, projection=projection)
+
+    @_contextlib.contextmanager
+    def _collect_config(self):
+        # Yields a dict that is filled with the merged config options when the
+        # block exits cleanly, it stays empty for nested transactions
+        options = {}
+        if self.id in _config_batches:
+            yield options
+            return
+
+        batch = _config_batches[self.id] = _ConfigBatch()
+        try:
+            yield options
+        except BaseException:
+            self._cache.clear()
+            raise
+        finally:
+            del _config_batches[self.id]
+        options.update(batch.merged())
+
+    @_contextlib.contextmanager
+    def transaction(self):
+        """Collect all config writes inside the block into a single `config` call
+
+        Attribute writes update the local cache right away, the merged
+        changes are sent when the block exits. If the block raises, nothing
+        is written and the cached values are dropped.
+        """
+        with self._collect_config() as options:
+            yield self
+        if options:
+            config(self.id, **options)
 
     def rmi(self, **options):
         return rmi(self.imageid, **options)
@@ -256,20 +1570,41 @@ class Container(Inspectable):
         return add(self.id, source, *args, **options)
 
     def add_contents(self, contents, *args, mode=None, **options):
-        with _tempfile.NamedTemporaryFile() as f:
-            if mode is not None:
-                _os.fchmod(f.fileno(), mode)
-            f.write(contents)
-            f.flush()
-            return add(self.id, f.name, *args, **options)
+        with _contents_file(contents, mode) as path:
+            return add(self.id, path, *args, **options)
+
+    def export(self, fileobj, compression=None, threads=None, progress=None, **options):
+        return export(self.id, fileobj, compression, threads, progress, **options)
+
+    def sync(self, source, destination, full=False):
+        return self.fs.sync(source, destination, full)
+
+    def add_files(self, files, destination="/", **options):
+        """Add many in-memory files with a single `add` of one tar archive
+
+        `files` maps paths below `destination` to bytes, file objects or
+        `(bytes | file object, mode, uid, gid)` tuples. Returns the digest
+        `add` reports.
+        """
+        with _files_tar(files) as path:
+            return add(self.id, path, destination, **options).strip()
 
     def copy(self, source, *args, **options):
         return copy(self.id, source, *args, **options)
 
     @_contextlib.contextmanager
     def mount(self, **options):
-        yield list(mount(self.id, **options).values())[0]
-        umount(self.id)
+        path = mount_manager.acquire(self.id, **options)
+        try:
+            yield path
+        finally:
+            mount_manager.release(self.id)
+
+    @property
+    def fs(self):
+        if self._fs is None:
+            self._fs = ContainerFS(self)
+        return self._fs
 
     def commit(self, image_name, **options):
         return commit(self.id, image_name, **options)
@@ -277,55 +1612,455 @@ class Container(Inspectable):
     def run(self, *args, **options):
         return run(self.id, *args, **options)
 
+    def run_many(self, cmds, stop_on_error=True, **options):
+        return run_many(self.id, cmds, stop_on_error=stop_on_error, **options)
 
-def rmi(name_or_id, **kwargs):
-    return _buildah("rmi", name_or_id, _capture_output=True, **kwargs)
 
+@_contextlib.contextmanager
+def _contents_file(contents, mode=None):
+    # A temporary file holding `contents` for `add` to pick up
+    with _tempfile.NamedTemporaryFile() as f:
+        if mode is not None:
+            _os.fchmod(f.fileno(), mode)
+        f.write(contents)
+        f.flush()
+        yield f.name
 
-def rm(name_or_id, **kwargs):
-    return _buildah("rm", name_or_id, _capture_output=True, **kwargs)
 
+@_contextlib.contextmanager
+def _files_tar(files):
+    # A temporary tar archive of the in-memory `files` of `add_files()`
+    now = _time.time()
+    with _tempfile.NamedTemporaryFile(suffix=".tar") as f:
+        with _tarfile.open(fileobj=f, mode="w") as tar:
+            for path, content in files.items():
+                mode, uid, gid = 0o644, 0, 0
+                if isinstance(content, tuple):
+                    content, mode, uid, gid = content
 
-def images(*args, **options):
-    return _buildah(
-        "images",
-        *args,
-        _list=True,
-        _json=True,
-        _wrapper=lambda x: Image(x["id"]),
-        **options
-    )
+                info = _tarfile.TarInfo(path.lstrip("/"))
+                info.mode, info.uid, info.gid, info.mtime = mode, uid, gid, now
+                if isinstance(content, (bytes, bytearray)):
+                    content = _io.BytesIO(content)
+                    info.size = len(content.getbuffer())
+                else:
+                    start = content.tell()
+                    info.size = content.seek(0, _os.SEEK_END) - start
+                    content.seek(start)
+                    try:
+                        info.mtime = _os.fstat(content.fileno()).st_mtime
+                    except (AttributeError, OSError, ValueError):
+                        pass
+                tar.addfile(info, content)
+        f.flush()
+        yield f.name
 
 
-def containers(*args, **options):
-    return _buildah(
-        "containers",
-        *args,
-        _list=True,
-        _json=True,
-        _wrapper=lambda x: Container(x["id"]),
-        **options
-    )
+class Recorder(Container):
+    """Container stand-in recording the steps of a build instead of running them
 
+    `run`, `copy`, `add` and config writes are recorded, host files are
+    copied into a build context right away. `commit()` turns the steps into
+    a Containerfile built by `bud --layers`, so buildah caches the layers
+    and the whole build is one process. Steps without a Containerfile
+    equivalent (like run options or removing config values) and everything
+    after them are executed directly on a container from what bud built.
 
-def inspect(image_or_container, **options):
-    try:
-        info = _json.loads(
-            _buildah(
+        recorder = Recorder("alpine:3.12")
+        recorder.run("apk add --no-cache python3")
+        recorder.copy("app", "/app")
+        recorder.env["PYTHONPATH"] = "/app"
+        image = recorder.commit("app")
+    """
+
+    id = property(lambda self: self._name_or_id)
+    name = property(lambda self: self._name_or_id)
+
+    # Containerfile instructions for config options taking plain values
+    _INSTRUCTIONS = {
+        "workingdir": "WORKDIR",
+        "user": "USER",
+        "stop_signal": "STOPSIGNAL",
+        "onbuild": "ONBUILD",
+        "author": "MAINTAINER",
+    }
+
+    def __init__(self, base):
+        self.base = base
+        self.steps = []
+        self._context = _tempfile.TemporaryDirectory(prefix="python-buildah-recorder-")
+        self.context = self._context.name
+        super().__init__(
+            "recorder-" + _os.path.basename(self.context),
+            prefetch=False,
+        )
+        _recordings[self.id] = self
+
+    def _sync(self):
+        pass
+
+    def inspect(self):
+        # Nothing exists yet, so all values start out empty
+        return {
+            "ContainerID": self.id,
+            "Container": self.id,
+            "FromImageID": "",
+            "ImageAnnotations": {},
+            "OCIv1": {"config": {}},
+            "Docker": {"config": {}},
+        }
+
+    def _record(self, kind, args, options):
+        self.steps.append((kind, tuple(args), dict(options)))
+
+    def _snapshot(self, sources):
+        # Copies the host files into a directory of the context per step
+        step = _os.path.join(self.context, str(len(self.steps)))
+        _os.makedirs(step, exist_ok=True)
+        snapshot = []
+        for source in sources:
+            source = str(source)
+            if "://" in source:
+                snapshot.append(source)
+                continue
+            target = _os.path.join(step, _os.path.basename(source.rstrip("/")) or "root")
+            if _os.path.isdir(source) and not _os.path.islink(source):
+                _shutil.copytree(source, target, symlinks=True)
+            else:
+                _shutil.copy2(source, target, follow_symlinks=False)
+            snapshot.append(_os.path.relpath(target, self.context))
+        return snapshot
+
+    def run(self, cmd, **options):
+        if isinstance(cmd, str):
+            cmd = ["sh", "-c", cmd]
+        self._record("run", (list(cmd),), options)
+
+    def run_many(self, cmds, stop_on_error=True, **options):
+        raise RuntimeError("Results of recorded steps are not available")
+
+    def copy(self, source, *args, **options):
+        *sources, destination = (source,) + args
+        if options.get("from") is None:
+            sources = self._snapshot(sources)
+        self._record("copy", sources + [destination], options)
+        return ""
+
+    def add(self, source, *args, **options):
+        *sources, destination = (source,) + args
+        if options.get("from") is None:
+            sources = self._snapshot(sources)
+        self._record("add", sources + [destination], options)
+        return ""
+
+    def mount(self, **options):
+        raise RuntimeError("Recorded containers cannot be mounted")
+
+    @property
+    def fs(self):
+        raise RuntimeError("Recorded containers have no filesystem")
+
+    @staticmethod
+    def _plain(*values):
+        # Whether values survive the variable expansion and escapes most
+        # Containerfile instructions apply to their arguments
+        return not any(_re.search(r"[$\\\x00-\x1f]", str(_)) for _ in values)
+
+    @staticmethod
+    def _quote(value):
+        # A double quoted Containerfile word meaning exactly `value`, `None`
+        # when control characters make that impossible
+        value = str(value)
+        if _re.search(r"[\x00-\x1f]", value):
+            return None
+        return '"{}"'.format(_re.sub(r'([\\"$])', r"\\\1", value))
+
+    def _instruction(self, kind, args, options):
+        # The Containerfile line for a step, `None` when there is none
+        _, options = _split_special(options)
+        if kind == "run":
+            return None if options else "RUN " + _json.dumps(args[0])
+
+        if kind in ("copy", "add"):
+            flags = []
+            for option in ("chown", "chmod", "from"):
+                if options.get(option) is not None:
+                    flags.append("--{}={}".format(option, options.pop(option)))
+            if options or not self._plain(*args, *flags):
+                return None
+            return " ".join([kind.upper()] + flags + [_json.dumps(list(args))])
+
+        lines = []
+        for option, value in options.items():
+            if option in ("env", "label"):
+                if not isinstance(value, dict) or None in value.values():
+                    return None
+                for k, v in value.items():
+                    if option == "env" and not _re.match(r"[A-Za-z_][A-Za-z0-9_]*$", k):
+                        return None
+                    key = k if option == "env" else self._quote(k)
+                    v = self._quote(v)
+                    if key is None or v is None:
+                        return None
+                    lines.append("{} {}={}".format("ENV" if option == "env" else "LABEL", key, v))
+            elif option in ("cmd", "entrypoint"):
+                value = _shlex.split(value) if isinstance(value, str) else list(value)
+                lines.append("{} {}".format(option.upper(), _json.dumps(value)))
+            elif option in ("port", "volume"):
+                value = [value] if isinstance(value, str) else list(value)
+                if any(str(_).endswith("-") for _ in value) or not self._plain(*value):
+                    return None
+                lines.append("{} {}".format(
+                    "EXPOSE" if option == "port" else "VOLUME",
+                    " ".join(str(_) for _ in value) if option == "port" else _json.dumps(value),
+                ))
+            elif option in self._INSTRUCTIONS and value is not None and self._plain(value):
+                lines.append("{} {}".format(self._INSTRUCTIONS[option], value))
+            else:
+                return None
+        return "\n".join(lines)
+
+    def containerfile(self):
+        """The Containerfile for the leading steps that have an equivalent, and their count"""
+        lines, count = ["FROM " + self.base], 0
+        for step in self.steps:
+            line = self._instruction(*step)
+            if line is None:
+                break
+            if line:
+                lines.append(line)
+            count += 1
+        return "\n".join(lines) + "\n", count
+
+    def commit(self, image_name, **options):
+        text, count = self.containerfile()
+        rest = self.steps[count:]
+        path = _os.path.join(self.context, "Containerfile")
+        with open(path, "wt") as f:
+            f.write(text)
+        if not rest:
+            return bud(self.context, file=path, tag=image_name, **options)
+
+        _log.info("Running %d of %d steps outside of bud", len(rest), len(self.steps))
+        intermediate = bud(self.context, file=path).id if count else None
+        container = from_(intermediate or self.base)
+        try:
+            for kind, args, step_options in rest:
+                if kind in ("copy", "add") and step_options.get("from") is None:
+                    *sources, destination = args
+                    sources = [_ if "://" in _ else _os.path.join(self.context, _) for _ in sources]
+                    args = sources + [destination]
+                {"run": run, "copy": copy, "add": add, "config": config}[kind](
+                    container.id, *args, **step_options
+                )
+            return container.commit(image_name, **options)
+        finally:
+            container.rm()
+            if intermediate is not None:
+                try:
+                    rmi(intermediate)
+                except BuildahError:
+                    _log.warning("Could not remove intermediate image %s", intermediate)
+
+    def rm(self, **options):
+        _recordings.pop(self.id, None)
+        self._context.cleanup()
+
+
+def rmi(name_or_id, **kwargs):
+    return _buildah("rmi", name_or_id, _capture_output=True, **kwargs)
+
+
+def rm(name_or_id, **kwargs):
+    if kwargs.get("all"):
+        mount_manager.forget_all()
+    mount_manager.forget(name_or_id)
+    return _buildah("rm", name_or_id, _capture_output=True, **kwargs)
+
+
+def images(*args, _prefetch=False, **options):
+    return _buildah(
+        "images",
+        *args,
+        _list=True,
+        _json=True,
+        _wrapper=lambda x: Image(x["id"], prefetch=_prefetch, listing=x),
+        **options
+    )
+
+
+def containers(*args, _prefetch=False, **options):
+    return _buildah(
+        "containers",
+        *args,
+        _list=True,
+        _json=True,
+        _wrapper=lambda x: Container(x["id"], prefetch=_prefetch, listing=x),
+        **options
+    )
+
+
+class _Encoded(str):
+    """A JSON document that is only decoded once it is accessed"""
+
+
+class _InspectInfo(dict):
+    """Inspect result decoding its JSON encoded parts on first access
+
+    Item access decodes just that item, whatever looks at all the values,
+    like `items()`, `copy()` or `json.dumps()`, decodes them all first.
+    """
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if isinstance(value, _Encoded):
+            value = _json.loads(value)
+            # `Config` is a JSON string within the JSON document
+            if key == "Config" and isinstance(value, str) and value:
+                value = _json.loads(value)
+            super().__setitem__(key, value)
+        return value
+
+    def __iter__(self):
+        # Keeps `dict()` and `{**info}` from copying the raw values, they go
+        # through `keys()` and item access instead
+        return super().__iter__()
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def _decode_all(self):
+        for key in list(self.keys()):
+            self[key]
+
+
+def _decoding_all(name):
+    method = getattr(dict, name)
+
+    @_functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._decode_all()
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+for _name in ("__eq__", "__ne__", "__repr__", "__or__", "items", "values", "copy", "pop", "popitem", "setdefault"):
+    if hasattr(dict, _name):
+        setattr(_InspectInfo, _name, _decoding_all(_name))
+
+
+# JSON names of the fields below the top level of inspect results, where
+# they differ from the Go names templates use
+_JSON_NAMES = {
+    "Created": "created",
+    "Author": "author",
+    "Architecture": "architecture",
+    "OS": "os",
+    "Config": "config",
+    "RootFS": "rootfs",
+    "DiffIDs": "diff_ids",
+    "History": "history",
+}
+
+
+def _inspect_format(fields):
+    # One document per line, so each of them can be decoded on its own. The
+    # parent of nested fields may be a nil pointer, like `Docker.Config`,
+    # which templates refuse to look into
+    lines = []
+    for field in fields:
+        parent, _, name = field.rpartition(".")
+        if parent:
+            lines.append("{{with .%s}}{{json .%s}}{{else}}null{{end}}" % (parent, name))
+        else:
+            lines.append("{{json .%s}}" % name)
+    return "\n".join(lines)
+
+
+def _decode_inspect(output, fields=None):
+    if not fields:
+        info = _json.loads(output)
+        if isinstance(info.get("Config"), str) and info["Config"]:
+            info["Config"] = _Encoded(info["Config"])
+        return _InspectInfo(info)
+
+    # Nested fields are put where they are in full results, so readers
+    # work on both
+    info = _InspectInfo()
+    for field, line in zip(fields, output.splitlines()):
+        *parents, name = [
+            _JSON_NAMES.get(_, _) if i else _
+            for i, _ in enumerate(field.split("."))
+        ]
+        target = info
+        for parent in parents:
+            if parent not in target:
+                dict.__setitem__(target, parent, _InspectInfo())
+            target = dict.__getitem__(target, parent)
+            if not isinstance(target, _InspectInfo):
+                # Asked for as a whole as well
+                break
+        else:
+            dict.__setitem__(target, name, _Encoded(line))
+    return info
+
+
+def _cacheable(fields, options):
+    return not fields and set(options) <= {"type"}
+
+
+def inspect(image_or_container, _fields=None, **options):
+    cacheable = _cacheable(_fields, options)
+    if cacheable:
+        info = inspect_cache.get(image_or_container, options.get("type"))
+        if info is not None:
+            return info
+
+    if _fields:
+        options["format"] = _inspect_format(_fields)
+    try:
+        info = _decode_inspect(
+            _buildah(
                 "inspect",
                 image_or_container,
                 _capture_output=True,
                 **options
             ),
+            _fields,
         )
-        if info.get("Config"):
-            info["Config"] = _json.loads(info["Config"])
-        return info
+    except BuildahTransientError:
+        raise
     except BuildahError as e:
         raise BuildahNotFound(
             "Could not find container or image {!r}".format(image_or_container),
         ) from e
 
+    if cacheable:
+        inspect_cache.put(image_or_container, options.get("type"), info)
+    return info
+
+
+def inspect_many(names_or_ids, max_workers=None, **options):
+    """Inspect concurrently, maps each name or id to its info or the error
+
+    Errors are a `BuildahNotFound` or, when the storage was busy, a
+    `BuildahTransientError`.
+    """
+    names_or_ids = list(dict.fromkeys(names_or_ids))
+
+    def inspect_one(name_or_id):
+        try:
+            return inspect(name_or_id, **options)
+        except (BuildahNotFound, BuildahTransientError) as e:
+            return e
+
+    if not names_or_ids:
+        return {}
+
+    with _futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return dict(zip(names_or_ids, pool.map(inspect_one, names_or_ids)))
+
 
 def from_(base, _wrapper=Container, **options):
     f = _tempfile.NamedTemporaryFile(mode="w+t")
@@ -350,22 +2085,304 @@ def commit(name_or_id, image_name, **options):
     )
 
 
-def unshare():
+def bud(context, layers=True, **options):
+    """Build the Containerfile in `context` (or `file`), returns the `Image`"""
+    f = _tempfile.NamedTemporaryFile(mode="w+t")
+    _buildah(
+        "bud",
+        context,
+        _capture_output=True,
+        layers=layers or None,
+        iidfile=f.name,
+        **options,
+    )
+    return Image(f.read().strip())
+
+
+# Source of the helper `UnshareWorker` runs inside `buildah unshare`. It reads
+# one JSON request per line and answers with messages carrying the output
+# chunks and eventually the exit code and resource usage.
+_WORKER_SOURCE = r"""
+import os, sys, json, base64, signal, threading, selectors, subprocess
+
+lock = threading.Lock()
+procs = {}
+
+
+def send(message):
+    with lock:
+        sys.stdout.write(json.dumps(message) + "\n")
+        sys.stdout.flush()
+
+
+def execute(request):
+    id_ = request["id"]
+    try:
+        proc = subprocess.Popen(
+            request["cmd"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+    except OSError as e:
+        send({"id": id_, "error": str(e)})
+        return
+    procs[id_] = proc
+    with selectors.DefaultSelector() as selector:
+        selector.register(proc.stdout, selectors.EVENT_READ, "stdout")
+        selector.register(proc.stderr, selectors.EVENT_READ, "stderr")
+        while selector.get_map():
+            for key, _ in selector.select():
+                chunk = os.read(key.fd, 65536)
+                if chunk:
+                    send({"id": id_, "stream": key.data, "data": base64.b64encode(chunk).decode()})
+                else:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+    _, status, rusage = os.wait4(proc.pid, 0)
+    procs.pop(id_, None)
+    send({
+        "id": id_,
+        "returncode": -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status),
+        "rusage": [rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss],
+    })
+
+
+for line in sys.stdin:
+    request = json.loads(line)
+    if request.get("kill"):
+        # Whatever the call started has to go as well
+        if request["id"] in procs:
+            os.killpg(procs[request["id"]].pid, signal.SIGKILL)
+    else:
+        threading.Thread(target=execute, args=(request,), daemon=True).start()
+"""
+
+
+class _WorkerProcess:
+    """A buildah call running in an `UnshareWorker`"""
+
+    def __init__(self, worker, cmd, capture_output):
+        self._worker = worker
+        self._capture_output = capture_output
+        self._queue = _queue.Queue()
+        self._id = worker._register(self._queue)
+        self._rusage = None
+        self._error = None
+        self.returncode = None
+        worker._send({"id": self._id, "cmd": [str(_) for _ in cmd]})
+
+    def chunks(self):
+        while self.returncode is None:
+            if self._error is not None:
+                raise self._error
+            message = self._queue.get()
+            if "stream" in message:
+                data = _base64.b64decode(message["data"])
+                if message["stream"] == "stdout" and not self._capture_output:
+                    # What a local child would have written to our stdout
+                    _os.write(1, data)
+                else:
+                    yield message["stream"], data
+                continue
+
+            self._worker._unregister(self._id)
+            if "error" in message:
+                # Kept, so `wait()` after a failed read does not read again
+                self._error = BuildahError(message["error"])
+                raise self._error
+            self.returncode = message["returncode"]
+            utime, stime, maxrss = message["rusage"]
+            self._rusage = _types.SimpleNamespace(ru_utime=utime, ru_stime=stime, ru_maxrss=maxrss)
+
+    def kill(self):
+        if self.returncode is None and self._error is None:
+            self._worker._send({"id": self._id, "kill": True})
+
+    def wait(self):
+        for _ in self.chunks():
+            pass
+        return self._rusage
+
+
+class UnshareWorker:
+    """Long lived `buildah unshare` helper running buildah calls on our behalf
+
+    Namespace setup is paid once and this process never re-executes. Mount
+    points only exist within the worker's mount namespace though, so
+    `Container.fs` falls back to `run` and friends while a worker is used.
+    """
+
+    def __init__(self):
+        cmd = [executable] + _optify(global_options) + ["unshare", _sys.executable, "-c", _WORKER_SOURCE]
+        self._proc = _sp.Popen(cmd, stdin=_sp.PIPE, stdout=_sp.PIPE)
+        self._lock = _threading.Lock()
+        self._queues = {}
+        self._gone = False
+        self._ids = _itertools.count()
+        self._reader = _threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _register(self, queue):
+        with self._lock:
+            id_ = next(self._ids)
+            if self._gone:
+                queue.put({"error": "The unshare worker exited"})
+            else:
+                self._queues[id_] = queue
+            return id_
+
+    def _unregister(self, id_):
+        with self._lock:
+            self._queues.pop(id_, None)
+
+    def _send(self, message):
+        with self._lock:
+            try:
+                self._proc.stdin.write(_json.dumps(message).encode() + b"\n")
+                self._proc.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                queue = self._queues.get(message["id"])
+                if queue is not None:
+                    queue.put({"error": "The unshare worker is gone"})
+
+    def _read(self):
+        for line in self._proc.stdout:
+            message = _json.loads(line)
+            with self._lock:
+                queue = self._queues.get(message["id"])
+            if queue is not None:
+                queue.put(message)
+        with self._lock:
+            self._gone = True
+            for queue in self._queues.values():
+                queue.put({"error": "The unshare worker exited"})
+
+    def spawn(self, cmd, capture_output):
+        return _WorkerProcess(self, cmd, capture_output)
+
+    def close(self):
+        global _worker
+        # Mounts made by the worker are only reachable through it
+        mount_manager.close()
+        if _worker is self:
+            _worker = None
+        self._proc.stdin.close()
+        self._proc.wait()
+        self._reader.join()
+
+
+def unshare(worker=False):
+    """Get into buildah's user namespace, needed when running rootless
+
+    By default the whole process is re-executed under `buildah unshare`.
+    With `worker`, an `UnshareWorker` is started instead and all further
+    calls are routed through it.
+    """
+    global _worker
     if "BUILDAH_ISOLATION" in _os.environ:
         return
+    if worker:
+        if _worker is None:
+            _worker = UnshareWorker()
+            _atexit.register(_worker.close)
+        return _worker
     cmdline = open("/proc/self/cmdline", "rt").read().split("\0")
-    cmdline = ["buildah"] + _optify(global_options) + ["unshare"] + cmdline
-    _os.execvp("buildah", cmdline)
+    cmdline = [executable] + _optify(global_options) + ["unshare"] + cmdline
+    _os.execvp(executable, cmdline)
 
 
 def run(name_or_id, cmd, **options):
+    recorder = _recordings.get(name_or_id)
+    if recorder is not None:
+        return recorder.run(cmd, **options)
     if isinstance(cmd, str):
         cmd = ["sh", "-c", cmd]
 
+    if options.get("_stream") or options.get("_sink") is not None:
+        return _buildah_stream("run", name_or_id, *cmd, **options)
     return _buildah("run", name_or_id, *cmd, **options)
 
 
+RunResult = _collections.namedtuple("RunResult", "cmd returncode stdout stderr duration")
+
+# Runs each argument after the first two as a shell command, writes a header
+# line per command followed by its stdout and stderr. The header is the
+# token, index, exit code, start and end (seconds since boot) and the sizes.
+_RUN_MANY_DRIVER = r"""
+token="$1"
+stop="$2"
+shift 2
+d=$(mktemp -d 2>/dev/null) || { d="/tmp/.run-many-$token"; mkdir -p "$d" || exit 125; }
+trap 'rm -rf "$d"' EXIT
+now() { { read -r u _ </proc/uptime; } 2>/dev/null && echo "$u" || date +%s; }
+i=0
+for c in "$@"; do
+    start=$(now)
+    sh -c "$c" >"$d/out" 2>"$d/err" </dev/null
+    rc=$?
+    end=$(now)
+    echo "$token $i $rc $start $end $(wc -c <"$d/out") $(wc -c <"$d/err")"
+    cat "$d/out" "$d/err"
+    i=$((i + 1))
+    if [ "$rc" -ne 0 ] && [ "$stop" = 1 ]; then
+        break
+    fi
+done
+"""
+
+
+def run_many(name_or_id, cmds, stop_on_error=True, binary=False, **options):
+    """Run several commands in a single `buildah run`
+
+    Commands are handled like `run` does, strings go through `sh -c`. Returns
+    a `RunResult` per command that was run, with stdout and stderr decoded
+    unless `binary` is set.
+    """
+    cmds = list(cmds)
+    token = _os.urandom(8).hex()
+    scripts = [_ if isinstance(_, str) else _shlex_join(_) for _ in cmds]
+    output = bytearray()
+    for name, data in run(
+        name_or_id,
+        ["sh", "-c", _RUN_MANY_DRIVER, "sh", token, "1" if stop_on_error else "0", *scripts],
+        _stream=True,
+        _binary=True,
+        **options,
+    ):
+        if name == "stdout":
+            output += data
+
+    results = []
+    pos = 0
+    while pos < len(output):
+        end = output.index(b"\n", pos)
+        header = output[pos:end].decode().split()
+        if len(header) != 7 or header[0] != token:
+            raise BuildahError("Unexpected output from run_many: {!r}".format(bytes(output[pos:end])))
+        index, returncode, start, stop, stdout_size, stderr_size = header[1:]
+        pos = end + 1
+        stdout = bytes(output[pos:pos + int(stdout_size)])
+        pos += int(stdout_size)
+        stderr = bytes(output[pos:pos + int(stderr_size)])
+        pos += int(stderr_size)
+        if not binary:
+            stdout, stderr = _decode(stdout), _decode(stderr)
+        results.append(RunResult(
+            cmds[int(index)],
+            int(returncode),
+            stdout,
+            stderr,
+            round(float(stop) - float(start), 2),
+        ))
+    return results
+
+
 def copy(name_or_id, *args, **options):
+    recorder = _recordings.get(name_or_id)
+    if recorder is not None:
+        return recorder.copy(*args, **options)
     return _buildah("copy", name_or_id, *args, _capture_output=True, **options)
 
 
@@ -373,8 +2390,7 @@ def info():
     return _buildah("info", _json=True, _json_flag=False)
 
 
-def mount(*names_or_ids, **options):
-    output = _buildah("mount", *names_or_ids, _capture_output=True, **options)
+def _parse_mounts(names_or_ids, output):
     output = output.strip()
 
     if not output:
@@ -385,13 +2401,175 @@ def mount(*names_or_ids, **options):
     return {names_or_ids[0]: output}
 
 
+def mount(*names_or_ids, **options):
+    output = _buildah("mount", *names_or_ids, _capture_output=True, **options)
+    return _parse_mounts(names_or_ids, output)
+
+
+class _GzipWriter:
+    """Writes a single gzip member, deflating chunks on a thread pool
+
+    Like pigz, every chunk is compressed on its own as raw deflate ending
+    in a sync flush, primed with the last 32 KiB of the chunk before it.
+    The pieces concatenate into one deflate stream, zlib releases the GIL
+    while compressing, so this scales with `threads`.
+    """
+
+    _HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+    def __init__(self, fileobj, threads=None, level=6, chunk_size=1 << 20):
+        self._fileobj = fileobj
+        self._level = level
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._previous = b""
+        self._crc = 0
+        self._size = 0
+        self._threads = threads or _os.cpu_count() or 1
+        self._pool = _futures.ThreadPoolExecutor(max_workers=self._threads)
+        self._pending = _collections.deque()
+        self._fileobj.write(self._HEADER)
+
+    def _compress(self, chunk, dictionary):
+        compressor = _zlib.compressobj(self._level, _zlib.DEFLATED, -15, zdict=dictionary)
+        return compressor.compress(chunk) + compressor.flush(_zlib.Z_SYNC_FLUSH)
+
+    def _drain(self, keep):
+        # Writes finished pieces in order, keeping the pool busy meanwhile
+        while len(self._pending) > keep:
+            self._fileobj.write(self._pending.popleft().result())
+
+    def _submit(self, chunk):
+        # The checksum is cheap and needs the order, so it stays here
+        self._crc = _zlib.crc32(chunk, self._crc)
+        self._size += len(chunk)
+        self._pending.append(self._pool.submit(self._compress, chunk, self._previous))
+        self._previous = chunk[-32768:]
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            chunk = bytes(self._buffer[:self._chunk_size])
+            del self._buffer[:self._chunk_size]
+            self._submit(chunk)
+            self._drain(2 * self._threads)
+        return len(data)
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        try:
+            self._drain(0)
+        finally:
+            self._pool.shutdown()
+        # An empty final block ends the deflate stream
+        self._fileobj.write(_zlib.compressobj(self._level, _zlib.DEFLATED, -15).flush())
+        self._fileobj.write(_struct.pack("<II", self._crc, self._size & 0xFFFFFFFF))
+
+
+class _Counter:
+    """Counts what goes through to `fileobj`, reporting it to `progress`"""
+
+    def __init__(self, fileobj, progress=None, interval=0.5):
+        self._fileobj = fileobj
+        self._progress = progress
+        self._interval = interval
+        self.start = self._last = _time.monotonic()
+        self.files = 0
+        self.read = 0
+        self.written = 0
+
+    def write(self, data):
+        self._fileobj.write(data)
+        self.written += len(data)
+        if self._progress is not None and _time.monotonic() - self._last >= self._interval:
+            self.report()
+        return len(data)
+
+    def report(self):
+        self._last = _time.monotonic()
+        stats = self.stats()
+        if self._progress is not None:
+            self._progress(stats)
+        return stats
+
+    def stats(self):
+        duration = _time.monotonic() - self.start
+        return {
+            "files": self.files,
+            "bytes": self.read,
+            "written": self.written,
+            "duration": duration,
+            "throughput": self.read / duration if duration else 0,
+        }
+
+
+def export(name_or_id, fileobj, compression=None, threads=None, progress=None, level=None, **options):
+    """Write the root filesystem of a container to `fileobj` as a tar stream
+
+    The container is mounted and its files go straight into the stream,
+    compressed with "gzip" or "zstd" (needs the zstandard package) on
+    `threads` threads. `progress` is called every half second and once at
+    the end with a dict of the `files` and uncompressed `bytes` so far, the
+    compressed bytes `written`, the `duration` and the `throughput` in bytes
+    per second, the last of these dicts is returned.
+    """
+    if compression not in (None, "gzip", "zstd"):
+        raise ValueError("Unknown compression {!r}".format(compression))
+    if compression == "zstd" and _zstd is None:
+        raise RuntimeError("zstd compression needs the zstandard package")
+    if _worker is not None:
+        raise RuntimeError("Mount points of the unshare worker are not reachable, export needs one")
+
+    counter = _Counter(fileobj, progress)
+    if compression == "gzip":
+        compressor = _GzipWriter(counter, threads, 6 if level is None else level)
+    elif compression == "zstd":
+        compressor = _zstd.ZstdCompressor(
+            level=3 if level is None else level,
+            threads=threads or -1,
+        ).stream_writer(counter, closefd=False)
+    else:
+        compressor = None
+
+    class Reader:
+        # Counts the uncompressed tar bytes
+        def write(self, data):
+            counter.read += len(data)
+            return (compressor or counter).write(data)
+
+    def count(tarinfo):
+        counter.files += 1
+        return tarinfo
+
+    container_id = mount_manager._resolve(name_or_id)
+    root = mount_manager.acquire(container_id, **options)
+    try:
+        with _tarfile.open(fileobj=Reader(), mode="w|", format=_tarfile.PAX_FORMAT) as tar:
+            for name in sorted(_os.listdir(root)):
+                tar.add(_os.path.join(root, name), arcname=name, filter=count)
+        if compressor is not None:
+            compressor.close()
+    finally:
+        mount_manager.release(container_id)
+    return counter.report()
+
+
 def umount(*names_or_ids, **options):
+    if options.get("all"):
+        mount_manager.forget_all()
+    for name_or_id in names_or_ids:
+        mount_manager.forget(name_or_id)
     output = _buildah("umount", *names_or_ids, _capture_output=True, **options)
     output = output.strip()
     return output.split("\n")
 
 
 def add(name_or_id, *args, **options):
+    recorder = _recordings.get(name_or_id)
+    if recorder is not None:
+        return recorder.add(*args, **options)
     return _buildah("add", name_or_id, *args, _capture_output=True, **options)
 
 
@@ -399,7 +2577,7 @@ def _shlex_join(l):
     return " ".join(_shlex.quote(_) for _ in l)
 
 
-def config(name_or_id, **options):
+def _config_options(options):
     def list_writer(x):
         return [f"{k}={v}" if v is not None else f"{k}-" for k, v in x.items()]
 
@@ -427,7 +2605,14 @@ def config(name_or_id, **options):
         if key not in writer:
             continue
         options[key] = writer[key](value)
-    return _buildah("config", name_or_id, **options)
+    return options
+
+
+def config(name_or_id, **options):
+    recorder = _recordings.get(name_or_id)
+    if recorder is not None:
+        return recorder._record("config", (), options)
+    return _buildah("config", name_or_id, **_config_options(options))
 
 
 def pull(name, **options):
@@ -446,3 +2631,1533 @@ def push(name_or_id, destination, **options):
 
 def tag(name_or_id, *aliases, **options):
     return _buildah("tag", name_or_id, *aliases, **options)
+
+
+def _platform(platform):
+    os, arch, *variant = platform.split("/")
+    return dict(os=os, arch=arch, variant=variant[0] if variant else None)
+
+
+def build_platforms(base, recipe, platforms, image_name, max_workers=None, **from_options):
+    """Build `base` + `recipe` for each of `platforms` concurrently
+
+    Platforms are given like "linux/amd64" or "linux/arm/v7", each build
+    is committed as `image_name` suffixed with its platform. Returns a dict
+    mapping the platforms to their `Image`, to be stitched together with
+    `Manifest.create()`.
+    """
+
+    def build(platform):
+        container = from_(base, **_platform(platform), **from_options)
+        try:
+            recipe(container)
+            return container.commit("{}-{}".format(image_name, platform.replace("/", "-")))
+        finally:
+            container.rm()
+
+    with _futures.ThreadPoolExecutor(max_workers=max_workers or len(platforms) or 1) as pool:
+        return dict(zip(platforms, pool.map(build, platforms)))
+
+
+class Manifest:
+    """A manifest list, wrapping `buildah manifest`"""
+
+    def __init__(self, name):
+        self.name = name
+
+    @classmethod
+    def create(cls, name, *images, **options):
+        """Create the list `name`, adding `images` to it"""
+        _buildah("manifest create", name, **options)
+        manifest = cls(name)
+        for image in images:
+            manifest.add(image)
+        return manifest
+
+    def add(self, image, **options):
+        """Add an `Image` or reference, `arch`, `os` and `variant` are taken from the image by default"""
+        image = image.id if isinstance(image, Image) else image
+        return _buildah("manifest add", self.name, image, _capture_output=True, **options)
+
+    def remove(self, digest):
+        return _buildah("manifest remove", self.name, digest)
+
+    def inspect(self):
+        return _buildah("manifest inspect", self.name, _json=True, _json_flag=False)
+
+    def push(self, destination, **options):
+        options.setdefault("all", True)
+        return _buildah("manifest push", self.name, destination, **options)
+
+    def rm(self):
+        return _buildah("manifest rm", self.name)
+
+
+class TransferManager:
+    """Pulls and pushes with deduplication and bounded concurrency
+
+    Concurrent pulls of the same reference share one `buildah pull`. The
+    `policy` decides when to pull at all: "always", "missing" (skip when
+    `images` knows the reference) or "newer" (left to `pull --policy`).
+    Every transfer is recorded in `transfers` as a dict with the `op`, the
+    `ref`, the `destination` of pushes, the `duration`, the image size in
+    `bytes` and whether it was `skipped` or `shared` with another caller.
+    """
+
+    POLICIES = ("always", "missing", "newer")
+
+    def __init__(self, policy="missing", max_workers=4):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown pull policy {!r}".format(policy))
+        self.policy = policy
+        self.max_workers = max_workers
+        self.transfers = []
+        self._lock = _threading.Lock()
+        self._pulls = {}
+
+    def _size(self, image):
+        # The listing carries the size, a pushed reference may not have one
+        listing = image._listing or {}
+        if "size" not in listing:
+            listing = self._local(image._name_or_id)
+            listing = listing._listing if listing is not None else {}
+        return _parse_size(listing["size"]) if "size" in listing else None
+
+    def _record(self, op, ref, start, size=None, **extra):
+        duration = _time.time() - start
+        transfer = dict(op=op, ref=ref, duration=duration, bytes=size, **extra)
+        with self._lock:
+            self.transfers.append(transfer)
+        return transfer
+
+    def _local(self, ref):
+        try:
+            found = images(ref)
+        except BuildahError:
+            return None
+        return found[0] if found else None
+
+    def pull(self, ref, policy=None, **options):
+        """Pull `ref` unless the policy says otherwise, returns the `Image`"""
+        policy = policy or self.policy
+        start = _time.time()
+        if policy == "missing":
+            image = self._local(ref)
+            if image is not None:
+                self._record("pull", ref, start, self._size(image), skipped=True, shared=False)
+                return image
+        elif policy == "newer":
+            options.setdefault("policy", "newer")
+
+        with self._lock:
+            future = self._pulls.get(ref)
+            owner = future is None
+            if owner:
+                future = self._pulls[ref] = _futures.Future()
+
+        if not owner:
+            image = future.result()
+            self._record("pull", ref, start, skipped=False, shared=True)
+            return image
+
+        try:
+            image = pull(ref, **options)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(image)
+        finally:
+            with self._lock:
+                del self._pulls[ref]
+        self._record("pull", ref, start, self._size(image), skipped=False, shared=False)
+        return image
+
+    def push(self, image, destinations, max_workers=None, **options):
+        """Push `image` to all `destinations` concurrently
+
+        Maps each destination to `None` or the `BuildahError` it failed with.
+        """
+        if not isinstance(image, Image):
+            image = Image(image, prefetch=False)
+        destinations = list(dict.fromkeys(destinations))
+        size = self._size(image) if destinations else None
+
+        def push_one(destination):
+            start = _time.time()
+            try:
+                push(image._name_or_id, destination, **options)
+            except BuildahError as e:
+                return e
+            finally:
+                self._record("push", image._name_or_id, start, size, destination=destination)
+
+        if not destinations:
+            return {}
+
+        with _futures.ThreadPoolExecutor(max_workers=max_workers or self.max_workers) as pool:
+            return dict(zip(destinations, pool.map(push_one, destinations)))
+
+
+class ContainerPool:
+    """Containers created from `base` ahead of time, handed out by `acquire()`
+
+    A background thread keeps `size` containers ready. Released containers
+    go back to the pool when nothing ran, was copied or added, configured or
+    mounted in them, up to `max_idle` on top of `size`, otherwise they are
+    removed. Those are handed out again before the fresh ones. `hits`,
+    `misses` and `wait_time` tell how well the pool keeps up.
+
+        pool = ContainerPool("alpine:3.12", size=4)
+        with pool.container() as container:
+            container.run("true")
+        pool.close()
+    """
+
+    _MODIFYING = ("run", "copy", "add", "config", "mount")
+
+    def __init__(self, base, size=4, max_idle=None, **from_options):
+        self.base = base
+        self.size = size
+        self.max_idle = size if max_idle is None else max_idle
+        self.from_options = from_options
+        self.hits = 0
+        self.misses = 0
+        self.wait_time = 0
+        self._ready = _collections.deque()
+        self._out = {}
+        self._garbage = []
+        self._closed = False
+        self._condition = _threading.Condition()
+        self._hook = add_hook(self._watch)
+        self._thread = _threading.Thread(target=self._replenish, daemon=True)
+        self._thread.start()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def _watch(self, event):
+        if event["subcommand"] not in self._MODIFYING or event["returncode"] != 0:
+            return
+        # `mount` takes any number of containers, the others just one
+        names = event["args"] if event["subcommand"] == "mount" else event["args"][:1]
+        with self._condition:
+            for name in names:
+                if name in self._out:
+                    self._out[name] = True
+
+    def _replenish(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or self._garbage or len(self._ready) < self.size
+                )
+                if self._closed:
+                    return
+                garbage, self._garbage = self._garbage, []
+            for container in garbage:
+                try:
+                    container.rm()
+                except BuildahError:
+                    _log.warning("Could not remove pooled container %s", container.id)
+            with self._condition:
+                missing = self.size - len(self._ready)
+            if missing <= 0:
+                continue
+            try:
+                container = from_(self.base, **self.from_options)
+            except BuildahError:
+                _log.exception("Could not create a container from %s", self.base)
+                _time.sleep(1)
+                continue
+            with self._condition:
+                if self._closed:
+                    self._garbage.append(container)
+                    return
+                self._ready.append(container)
+                self._condition.notify_all()
+
+    def acquire(self):
+        """Take a ready container, creating one right away when none is"""
+        start = _time.time()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The pool is closed")
+            container = self._ready.popleft() if self._ready else None
+            if container is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._condition.notify_all()
+        if container is None:
+            container = from_(self.base, **self.from_options)
+        with self._condition:
+            self.wait_time += _time.time() - start
+            self._out[container.id] = False
+        return container
+
+    def release(self, container, modified=None):
+        """Give `container` back, `modified` overrides what the pool noticed"""
+        with self._condition:
+            noticed = self._out.pop(container.id, True)
+            modified = noticed if modified is None else modified
+            if not self._closed:
+                if not modified and len(self._ready) < self.size + self.max_idle:
+                    self._ready.appendleft(container)
+                else:
+                    self._garbage.append(container)
+                    self._condition.notify_all()
+                return
+        # Nothing is left to clean up after a closed pool
+        try:
+            container.rm()
+        except BuildahError:
+            _log.warning("Could not remove pooled container %s", container.id)
+
+    @_contextlib.contextmanager
+    def container(self, modified=None):
+        container = self.acquire()
+        try:
+            yield container
+        finally:
+            self.release(container, modified)
+
+    def close(self):
+        """Stop replenishing and remove the ready and released containers"""
+        remove_hook(self._hook)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        for container in list(self._ready) + self._garbage:
+            try:
+                container.rm()
+            except BuildahError:
+                _log.warning("Could not remove pooled container %s", container.id)
+        self._ready.clear()
+        self._garbage = []
+
+
+class Scheduler:
+    """Runs operations concurrently, one at a time per container or image
+
+    Operations submitted with the same `key` run in submission order, the
+    others in parallel on up to `max_workers` threads. Operations failing
+    with a `BuildahTransientError` are retried up to `retries` times after
+    a jittered exponential backoff starting at `backoff` seconds.
+
+        with Scheduler(max_workers=8) as scheduler:
+            futures = [scheduler.submit(c.id, c.run, "make") for c in containers]
+
+    `stats()` tells the time operations spent queued apart from the time
+    they ran, which is what to look at when sizing `max_workers`.
+    """
+
+    def __init__(self, max_workers=8, retries=5, backoff=0.1, max_backoff=5):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._pool = _futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = _threading.Lock()
+        self._queues = {}
+        self._stats = _collections.Counter()
+        self._max_wait = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Schedule `fn(*args, **kwargs)` after the earlier operations on `key`"""
+        future = _futures.Future()
+        task = (future, fn, args, kwargs, _time.monotonic())
+        if key is None:
+            self._pool.submit(self._execute, None, task)
+            return future
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append(task)
+                return future
+            self._queues[key] = _collections.deque()
+        self._pool.submit(self._execute, key, task)
+        return future
+
+    def buildah(self, subcommand, name_or_id, *args, **kwargs):
+        """Schedule a `buildah subcommand name_or_id ...` call keyed by `name_or_id`"""
+        return self.submit(name_or_id, _buildah, subcommand, name_or_id, *args, **kwargs)
+
+    def _delay(self, attempt):
+        return _random.uniform(0.5, 1.5) * min(self.max_backoff, self.backoff * 2 ** attempt)
+
+    def _execute(self, key, task):
+        future, fn, args, kwargs, queued = task
+        start = _time.monotonic()
+        if future.set_running_or_notify_cancel():
+            attempt = 0
+            while True:
+                try:
+                    result = fn(*args, **kwargs)
+                except BuildahTransientError as e:
+                    if attempt >= self.retries:
+                        future.set_exception(e)
+                        break
+                    _log.info("Retrying after %s", e.__class__.__name__)
+                    _time.sleep(self._delay(attempt))
+                    attempt += 1
+                except BaseException as e:
+                    future.set_exception(e)
+                    break
+                else:
+                    future.set_result(result)
+                    break
+
+            with self._lock:
+                self._stats["operations"] += 1
+                self._stats["retries"] += attempt
+                self._stats["failed"] += future.exception() is not None
+                self._stats["wait_time"] += start - queued
+                self._stats["exec_time"] += _time.monotonic() - start
+                self._max_wait = max(self._max_wait, start - queued)
+
+        if key is None:
+            return
+        with self._lock:
+            queue = self._queues[key]
+            if not queue:
+                del self._queues[key]
+                return
+            task = queue.popleft()
+        self._pool.submit(self._execute, key, task)
+
+    def stats(self):
+        """Counts of the `operations`, `retries` and `failed` ones and their timing"""
+        with self._lock:
+            stats = dict(self._stats)
+            operations = stats.get("operations", 0)
+            return {
+                "operations": operations,
+                "retries": stats.get("retries", 0),
+                "failed": stats.get("failed", 0),
+                "wait_time": stats.get("wait_time", 0),
+                "exec_time": stats.get("exec_time", 0),
+                "mean_wait": stats.get("wait_time", 0) / operations if operations else 0,
+                "mean_exec": stats.get("exec_time", 0) / operations if operations else 0,
+                "max_wait": self._max_wait,
+                "queued": sum(len(_) for _ in self._queues.values()),
+            }
+
+    def close(self, wait=True):
+        # Queued operations resubmit themselves, so let those drain first
+        if wait:
+            while True:
+                with self._lock:
+                    if not self._queues:
+                        break
+                _time.sleep(0.01)
+        self._pool.shutdown(wait=wait)
+
+
+class AsyncInspectable(Inspectable):
+    """Base for the asyncio counterparts, nothing is inspected before `await refresh()`"""
+
+    def __init__(self, name_or_id, listing=None):
+        super().__init__(name_or_id, prefetch=False, listing=listing)
+
+    def _sync(self):
+        # Nothing can be inspected without awaiting, so only a newer info
+        # someone else put into the shared cache is taken over
+        if self._info is None or inspect_cache.current(self._info):
+            return
+        if _resolved_id(self._info) in _config_batches:
+            return
+        latest = inspect_cache.latest(self._info)
+        if latest is not None:
+            self._info = latest
+            self._forget_config()
+
+    @property
+    def info(self):
+        if self._info is None:
+            raise RuntimeError(
+                "{!r} has not been inspected yet, await refresh() first".format(self._name_or_id),
+            )
+        return self._info
+
+    async def inspect(self):
+        return await async_inspect(self._name_or_id, type=self._TYPE)
+
+    async def refresh(self):
+        inspect_cache.invalidate(self._name_or_id)
+        self._info = await self.inspect()
+        self._projected = None
+        self._cache.clear()
+
+
+class AsyncImage(AsyncInspectable, Image):
+
+    async def rm(self):
+        return await async_rmi(self.id)
+
+    async def push(self, destination):
+        return await async_push(self.id, destination)
+
+    async def pull(self):
+        return await async_pull(self.id)
+
+    async def tag(self, *aliases):
+        return await async_tag(self.id, *aliases)
+
+
+class AsyncContainer(AsyncInspectable, Container):
+    """asyncio counterpart of `Container`
+
+    Attribute writes outside of `async with container.transaction()` still
+    run a blocking `config`, prefer transactions or `await container.config()`.
+    `fs`, `sync()` and `export()` block as well.
+    """
+
+    @_contextlib.asynccontextmanager
+    async def transaction(self):
+        with self._collect_config() as options:
+            yield self
+        if options:
+            await async_config(self.id, **options)
+
+    async def config(self, **options):
+        return await async_config(self.id, **options)
+
+    async def rmi(self, **options):
+        return await async_rmi(self.imageid, **options)
+
+    async def rm(self, **options):
+        return await async_rm(self.id, **options)
+
+    async def add(self, source, *args, **options):
+        return await async_add(self.id, source, *args, **options)
+
+    async def copy(self, source, *args, **options):
+        return await async_copy(self.id, source, *args, **options)
+
+    async def add_contents(self, contents, *args, mode=None, **options):
+        with _contents_file(contents, mode) as path:
+            return await async_add(self.id, path, *args, **options)
+
+    async def add_files(self, files, destination="/", **options):
+        with _files_tar(files) as path:
+            return (await async_add(self.id, path, destination, **options)).strip()
+
+    @_contextlib.asynccontextmanager
+    async def mount(self, **options):
+        # Shares the mounts with sync users, the manager blocks on buildah
+        loop = _asyncio.get_running_loop()
+        path = await loop.run_in_executor(
+            None,
+            _functools.partial(mount_manager.acquire, self.id, **options),
+        )
+        try:
+            yield path
+        finally:
+            await loop.run_in_executor(None, mount_manager.release, self.id)
+
+    async def commit(self, image_name, **options):
+        return await async_commit(self.id, image_name, **options)
+
+    async def run(self, *args, **options):
+        return await async_run(self.id, *args, **options)
+
+    async def run_many(self, cmds, stop_on_error=True, **options):
+        # Its output is parsed as bytes, which `_abuildah` does not return
+        return await _asyncio.get_running_loop().run_in_executor(
+            None,
+            _functools.partial(run_many, self.id, list(cmds), stop_on_error, **options),
+        )
+
+
+async def async_rmi(name_or_id, **kwargs):
+    return await _abuildah("rmi", name_or_id, _capture_output=True, **kwargs)
+
+
+async def _forget_mounts(*names_or_ids, clear=False):
+    # Resolving names may inspect, keep that off the loop
+    loop = _asyncio.get_running_loop()
+    if clear:
+        mount_manager.forget_all()
+    for name_or_id in names_or_ids:
+        await loop.run_in_executor(None, mount_manager.forget, name_or_id)
+
+
+async def async_rm(name_or_id, **kwargs):
+    await _forget_mounts(name_or_id, clear=kwargs.get("all", False))
+    return await _abuildah("rm", name_or_id, _capture_output=True, **kwargs)
+
+
+async def async_inspect(image_or_container, _fields=None, **options):
+    cacheable = _cacheable(_fields, options)
+    if cacheable:
+        info = inspect_cache.get(image_or_container, options.get("type"))
+        if info is not None:
+            return info
+
+    if _fields:
+        options["format"] = _inspect_format(_fields)
+    try:
+        info = _decode_inspect(
+            await _abuildah(
+                "inspect",
+                image_or_container,
+                _capture_output=True,
+                **options
+            ),
+            _fields,
+        )
+    except BuildahTransientError:
+        raise
+    except BuildahError as e:
+        raise BuildahNotFound(
+            "Could not find container or image {!r}".format(image_or_container),
+        ) from e
+
+    if cacheable:
+        inspect_cache.put(image_or_container, options.get("type"), info)
+    return info
+
+
+async def async_from_(base, **options):
+    with _tempfile.NamedTemporaryFile(mode="w+t") as f:
+        await _abuildah("from", base, _capture_output=True, cidfile=f.name, **options)
+        container = AsyncContainer(f.read())
+    container._info = await container.inspect()
+    return container
+
+
+async def async_commit(name_or_id, image_name, **options):
+    image = await _abuildah(
+        "commit",
+        name_or_id,
+        image_name,
+        _wrapper=lambda _: AsyncImage(_.strip()),
+        **options,
+    )
+    image._info = await image.inspect()
+    return image
+
+
+async def async_run(name_or_id, cmd, **options):
+    if isinstance(cmd, str):
+        cmd = ["sh", "-c", cmd]
+
+    return await _abuildah("run", name_or_id, *cmd, **options)
+
+
+async def async_copy(name_or_id, *args, **options):
+    return await _abuildah("copy", name_or_id, *args, _capture_output=True, **options)
+
+
+async def async_add(name_or_id, *args, **options):
+    return await _abuildah("add", name_or_id, *args, _capture_output=True, **options)
+
+
+async def async_mount(*names_or_ids, **options):
+    output = await _abuildah("mount", *names_or_ids, _capture_output=True, **options)
+    return _parse_mounts(names_or_ids, output)
+
+
+async def async_umount(*names_or_ids, **options):
+    await _forget_mounts(*names_or_ids, clear=options.get("all", False))
+    output = await _abuildah("umount", *names_or_ids, _capture_output=True, **options)
+    output = output.strip()
+    return output.split("\n")
+
+
+async def async_config(name_or_id, **options):
+    return await _abuildah("config", name_or_id, **_config_options(options))
+
+
+async def async_pull(name, **options):
+    image = await _abuildah(
+        "pull",
+        name,
+        quiet=True,
+        _wrapper=lambda x: AsyncImage(x.strip()),
+        **options,
+    )
+    image._info = await image.inspect()
+    return image
+
+
+async def async_push(name_or_id, destination, **options):
+    return await _abuildah(
+        "push",
+        name_or_id,
+        destination,
+        quiet=True,
+        **options,
+    )
+
+
+async def async_tag(name_or_id, *aliases, **options):
+    return await _abuildah("tag", name_or_id, *aliases, **options)
+
+
+def _cache_dir():
+    return _os.path.join(
+        _os.environ.get("XDG_CACHE_HOME") or _os.path.expanduser("~/.cache"),
+        "python-buildah",
+    )
+
+
+def _parse_size(value):
+    # `images --json` reports sizes like "5.8 MB" (decimal units)
+    number, _, unit = str(value).partition(" ")
+    units = {"B": 1, "kB": 1e3, "KB": 1e3, "MB": 1e6, "GB": 1e9, "TB": 1e12}
+    return int(float(number) * units.get(unit, 1))
+
+
+def _digest_path(path, h=None):
+    h = h or _hashlib.sha256()
+    if _os.path.isdir(path) and not _os.path.islink(path):
+        for root, dirs, files in _os.walk(path):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                full = _os.path.join(root, name)
+                h.update(_os.path.relpath(full, path).encode() + b"\0")
+                if not _os.path.isdir(full) or _os.path.islink(full):
+                    _digest_path(full, h)
+        return h.hexdigest()
+
+    st = _os.lstat(path)
+    h.update(str(st.st_mode).encode() + b"\0")
+    if _os.path.islink(path):
+        h.update(_os.readlink(path).encode())
+    else:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class StepCache:
+    """On-disk index from build step keys to the images they committed
+
+    Keys hash the parent image id, the step kind, its arguments and options
+    and the contents of the host files it reads.
+    """
+
+    # Images committed for cache entries are tagged with this repository,
+    # which keeps them from being treated as dangling
+    REPOSITORY = "localhost/python-buildah-cache"
+    # A hit only writes the index when the recorded use is older than this,
+    # eviction does not need it any more precise
+    USED_RESOLUTION = 60
+
+    def __init__(self, path=None):
+        self.path = path or _os.path.join(_cache_dir(), "steps.json")
+        self._lock = _threading.RLock()
+        self._index = {}
+        self._stamp = None
+        self._load()
+
+    @staticmethod
+    def key(parent, kind, args, options=None, sources=()):
+        _, options = _split_special(options or {})
+        digests = [_digest_path(_) for _ in sources]
+        payload = [parent, kind, [str(_) for _ in args], sorted(options.items()), digests]
+        return _hashlib.sha256(_json.dumps(payload, default=str).encode()).hexdigest()
+
+    def _load(self):
+        # Other instances and processes share the file, read it again
+        # whenever it was replaced since
+        try:
+            st = _os.stat(self.path)
+        except FileNotFoundError:
+            self._index, self._stamp = {}, None
+            return
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stamp != self._stamp:
+            with open(self.path, "rt") as f:
+                self._index = _json.load(f)
+            self._stamp = stamp
+
+    @_contextlib.contextmanager
+    def _locked(self):
+        """Hold the index across threads and processes, with its latest
+        contents loaded, for a read-modify-write"""
+        with self._lock:
+            _os.makedirs(_os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".lock", "a") as lock:
+                _fcntl.flock(lock.fileno(), _fcntl.LOCK_EX)
+                self._load()
+                yield self._index
+
+    def _save(self):
+        with _tempfile.NamedTemporaryFile("wt", dir=_os.path.dirname(self.path), delete=False) as f:
+            _json.dump(self._index, f)
+        _os.replace(f.name, self.path)
+        st = _os.stat(self.path)
+        self._stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get(self, key):
+        with self._lock:
+            self._load()
+            entry = self._index.get(key)
+        if entry is None:
+            return None
+        try:
+            inspect(entry["image"], type="image")
+        except BuildahNotFound:
+            with self._locked() as index:
+                if index.get(key, {}).get("image") == entry["image"]:
+                    del index[key]
+                    self._save()
+            return None
+        now = _time.time()
+        if now - entry["used"] > self.USED_RESOLUTION:
+            with self._locked() as index:
+                if key in index:
+                    index[key]["used"] = now
+                    self._save()
+        return entry["image"]
+
+    def put(self, key, image, parent):
+        with self._locked() as index:
+            now = _time.time()
+            index[key] = {"image": image, "parent": parent, "created": now, "used": now}
+            self._save()
+
+    def evict(self, max_age=None, max_size=None):
+        """Remove entries unused for `max_age` seconds, then the least recently
+        used ones until their images take up at most `max_size` bytes
+
+        Returns the removed image ids.
+        """
+        with self._locked():
+            sizes = {
+                _["id"]: _parse_size(_.get("size", 0))
+                for _ in _buildah("images", _json=True) or []
+            }
+            entries = sorted(self._index.items(), key=lambda _: _[1]["used"])
+            total = sum(sizes.get(_["image"], 0) for _ in self._index.values())
+            now = _time.time()
+
+            candidates = []
+            for key, entry in entries:
+                expired = max_age is not None and now - entry["used"] > max_age
+                too_big = max_size is not None and total > max_size
+                if expired or too_big or entry["image"] not in sizes:
+                    candidates.append((key, entry))
+                    total -= sizes.get(entry["image"], 0)
+
+            # Children are always committed after their parents and have to
+            # go first, removing a parent fails otherwise
+            evicted = []
+            for key, entry in sorted(candidates, key=lambda _: -_[1]["created"]):
+                if entry["image"] in sizes:
+                    try:
+                        rmi(entry["image"], force=True)
+                    except BuildahError:
+                        _log.warning("Could not remove cached image %s", entry["image"])
+                        continue
+                    evicted.append(entry["image"])
+                del self._index[key]
+            self._save()
+            return evicted
+
+
+class CachedBuild:
+    """A `from_` → `run`/`copy`/`add`/`config` → `commit` sequence that skips
+    steps found in a `StepCache`
+
+    Every executed step is committed, a hit continues from its image. The
+    working container is only created once a step actually has to run.
+    """
+
+    def __init__(self, base, cache=None, **from_options):
+        self.cache = cache or StepCache()
+        self.report = []
+        self._from_options = from_options
+        self._container = None
+        try:
+            self.parent = Image(base).id
+        except BuildahNotFound:
+            self.parent = pull(base).id
+
+    @property
+    def hits(self):
+        return sum(1 for _ in self.report if _["hit"])
+
+    @property
+    def misses(self):
+        return sum(1 for _ in self.report if not _["hit"])
+
+    def _drop_container(self):
+        if self._container is not None:
+            self._container.rm()
+            self._container = None
+
+    def _step(self, kind, function, args, options, sources=()):
+        start = _time.time()
+        key = self.cache.key(self.parent, kind, args, options, sources)
+        image = self.cache.get(key)
+        hit = image is not None
+        if hit:
+            self._drop_container()
+        else:
+            if self._container is None:
+                self._container = from_(self.parent, **self._from_options)
+            function(self._container.id, *args, **options)
+            image = commit(
+                self._container.id,
+                "{}:{}".format(self.cache.REPOSITORY, key[:32]),
+            ).id
+            self.cache.put(key, image, self.parent)
+
+        self.report.append({
+            "kind": kind,
+            "args": [str(_) for _ in args],
+            "key": key,
+            "hit": hit,
+            "image": image,
+            "duration": _time.time() - start,
+        })
+        self.parent = image
+        return self
+
+    def run(self, cmd, **options):
+        return self._step("run", run, (cmd,), options)
+
+    def copy(self, *args, **options):
+        sources = [_ for _ in args[:-1] if _os.path.exists(_)]
+        return self._step("copy", copy, args, options, sources)
+
+    def add(self, *args, **options):
+        sources = [_ for _ in args[:-1] if _os.path.exists(_)]
+        return self._step("add", add, args, options, sources)
+
+    def config(self, **options):
+        return self._step("config", config, (), options)
+
+    def commit(self, image_name):
+        """Tag the image of the last step as `image_name`"""
+        self._drop_container()
+        tag(self.parent, image_name)
+        return Image(self.parent)
+
+
+BuildResult = _collections.namedtuple("BuildResult", "images containers timings critical_path")
+
+
+class BuildGraph:
+    """Stages with dependencies between them, built concurrently
+
+    Every stage runs its `recipe` on a container created from its `base`,
+    after copying in the `artifacts` of the stages it depends on. Stages
+    whose dependencies are done run in parallel, up to `parallelism`.
+
+        graph = BuildGraph(parallelism=2)
+        graph.stage("deps", "python:3.8", lambda c: c.run("pip install ..."))
+        graph.stage("assets", "node:14", lambda c: c.run("npm run build"))
+        graph.stage(
+            "final",
+            "python:3.8-slim",
+            lambda c: c.config(cmd=["python", "-m", "app"]),
+            artifacts=[("deps", "/venv", "/venv"), ("assets", "/dist", "/srv")],
+            commit="app",
+        )
+        result = graph.build()
+    """
+
+    def __init__(self, parallelism=4):
+        self.parallelism = parallelism
+        self.stages = {}
+
+    def stage(self, name, base, recipe=None, depends=(), artifacts=(), commit=None, **from_options):
+        """Declare a stage, `artifacts` being `(stage, source, destination)` tuples"""
+        if name in self.stages:
+            raise ValueError("Stage {!r} is declared already".format(name))
+        self.stages[name] = {
+            "base": base,
+            "recipe": recipe,
+            "depends": set(depends) | {_[0] for _ in artifacts},
+            "artifacts": list(artifacts),
+            "commit": commit,
+            "from_options": from_options,
+        }
+        return self
+
+    def _order(self):
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError("Stage {!r} depends on itself".format(name))
+            if name not in self.stages:
+                raise ValueError("Unknown stage {!r}".format(name))
+            visiting.add(name)
+            for dependency in sorted(self.stages[name]["depends"]):
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def _build_stage(self, name, containers):
+        stage = self.stages[name]
+        start = _time.time()
+        container = from_(stage["base"], **stage["from_options"])
+        containers[name] = container
+        for source_stage, source, destination in stage["artifacts"]:
+            container.copy(source, destination, **{"from": containers[source_stage].id})
+        if stage["recipe"] is not None:
+            stage["recipe"](container)
+        image = container.commit(stage["commit"]) if stage["commit"] else None
+        return image, {"start": start, "end": _time.time(), "duration": _time.time() - start}
+
+    def critical_path(self, timings):
+        """The chain of dependent stages that took the longest, and its duration"""
+        finish, previous = {}, {}
+        for name in self._order():
+            before = max(self.stages[name]["depends"], key=lambda _: finish[_], default=None)
+            finish[name] = timings[name]["duration"] + (finish[before] if before else 0)
+            previous[name] = before
+        if not finish:
+            return [], 0
+
+        name = max(finish, key=finish.get)
+        duration = finish[name]
+        path = []
+        while name is not None:
+            path.append(name)
+            name = previous[name]
+        return path[::-1], duration
+
+    def build(self, keep=False):
+        """Build all stages, returns a `BuildResult`
+
+        Stage containers are removed afterwards unless `keep` is set, and
+        always when a stage fails.
+        """
+        order = self._order()
+        pending = {name: set(self.stages[name]["depends"]) for name in order}
+        containers, images, timings = {}, {}, {}
+        running = {}
+        failure = None
+
+        with _futures.ThreadPoolExecutor(max_workers=self.parallelism) as pool:
+            while pending or running:
+                if failure is None:
+                    for name in [_ for _ in order if _ in pending and not pending[_]]:
+                        del pending[name]
+                        running[pool.submit(self._build_stage, name, containers)] = name
+                if not running:
+                    break
+
+                finished, _ = _futures.wait(running, return_when=_futures.FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        images[name], timings[name] = future.result()
+                    except Exception as e:
+                        _log.error("Stage %r failed: %s", name, e)
+                        failure = failure or e
+                        continue
+                    for dependencies in pending.values():
+                        dependencies.discard(name)
+
+        if failure is not None or not keep:
+            for container in containers.values():
+                try:
+                    container.rm()
+                except BuildahError:
+                    _log.warning("Could not remove container %s", container.id)
+        if failure is not None:
+            raise failure
+
+        return BuildResult(
+            images={k: v for k, v in images.items() if v is not None},
+            containers=containers if keep else {},
+            timings=timings,
+            critical_path=self.critical_path(timings),
+        )
+
+
+class Index:
+    """SQLite index of the images and containers of one storage root
+
+    Filled from the `images` and `containers` listings, only images new
+    since the last `refresh()` get inspected for their labels. The library's
+    own `rm` and `rmi` calls update the index directly, other mutating calls
+    mark it stale and the next query refreshes it. Changes made by anything
+    else show up after `refresh()` or once `max_age` seconds passed.
+
+        index = Index()
+        index.images(labels={"stage": "build"}, before=time.time() - 86400)
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            id TEXT PRIMARY KEY, digest TEXT, size INTEGER, created INTEGER, listing TEXT
+        );
+        CREATE TABLE IF NOT EXISTS image_names (
+            id TEXT, name TEXT, repository TEXT, tag TEXT
+        );
+        CREATE INDEX IF NOT EXISTS image_names_name ON image_names (name);
+        CREATE INDEX IF NOT EXISTS image_names_id ON image_names (id);
+        CREATE TABLE IF NOT EXISTS labels (id TEXT, key TEXT, value TEXT);
+        CREATE INDEX IF NOT EXISTS labels_key ON labels (key, value);
+        CREATE TABLE IF NOT EXISTS containers (
+            id TEXT PRIMARY KEY, name TEXT, image_id TEXT, image_name TEXT, listing TEXT
+        );
+    """
+
+    def __init__(self, path=None, max_age=300):
+        if path is None:
+            root = global_options.get("root") or "default"
+            path = _os.path.join(
+                _cache_dir(),
+                "index-{}.sqlite".format(_hashlib.sha256(str(root).encode()).hexdigest()[:16]),
+            )
+            _os.makedirs(_os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_age = max_age
+        self._lock = _threading.RLock()
+        self._db = _sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(self._SCHEMA)
+        self._refreshed = 0
+        self._stale = True
+        self._hook = add_hook(self._watch)
+
+    def close(self):
+        remove_hook(self._hook)
+        self._db.close()
+
+    # Calls that change what the listings show, `rm` and `rmi` are applied
+    # to the index right away
+    _CHANGING = ("from", "commit", "pull", "tag", "rm", "rmi")
+
+    def _watch(self, event):
+        subcommand = event["subcommand"]
+        if event["returncode"] != 0:
+            return
+        if subcommand not in self._CHANGING and not subcommand.startswith("manifest"):
+            return
+        with self._lock:
+            if subcommand == "rm" and not event["options"].get("all"):
+                with self._db:
+                    for arg in event["args"]:
+                        self._db.execute("DELETE FROM containers WHERE id = ? OR name = ?", (arg, arg))
+            elif subcommand == "rmi" and not event["options"].get("all"):
+                with self._db:
+                    for arg in event["args"]:
+                        ids = self._db.execute(
+                            "SELECT id FROM images WHERE id = ? UNION SELECT id FROM image_names WHERE name = ?",
+                            (arg, arg),
+                        ).fetchall()
+                        self._delete("images", [_ for _, in ids])
+                        # Untagging a name leaves the image, let the listing tell
+                        self._stale = self._stale or not ids or arg not in [_ for _, in ids]
+            else:
+                self._stale = True
+
+    def _delete(self, table, ids):
+        for id in ids:
+            if table == "images":
+                self._db.execute("DELETE FROM image_names WHERE id = ?", (id,))
+                self._db.execute("DELETE FROM labels WHERE id = ?", (id,))
+            self._db.execute("DELETE FROM {} WHERE id = ?".format(table), (id,))
+
+    def refresh(self):
+        """Bring the index in line with the listings, returns the new and removed ids"""
+        image_listings = {_["id"]: _ for _ in _buildah("images", _json=True, all=True) or []}
+        container_listings = {_["id"]: _ for _ in _buildah("containers", _json=True, all=True) or []}
+
+        with self._lock:
+            known = {_ for _, in self._db.execute("SELECT id FROM images")}
+            new = set(image_listings) - known
+            removed = known - set(image_listings)
+            infos = inspect_many(sorted(new), _fields=("OCIv1.Config.Labels",), type="image") if new else {}
+
+            with self._db:
+                self._delete("images", removed)
+                self._db.execute("DELETE FROM image_names")
+                for id, listing in image_listings.items():
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)",
+                        (id, listing.get("digest"), _parse_size(listing.get("size", 0)),
+                         listing.get("created"), _json.dumps(listing)),
+                    )
+                    for name in listing.get("names") or []:
+                        repository, _, tag = name.rpartition(":")
+                        if "/" in tag:
+                            repository, tag = name, ""
+                        self._db.execute(
+                            "INSERT INTO image_names VALUES (?, ?, ?, ?)",
+                            (id, name, repository, tag),
+                        )
+                for id, info in infos.items():
+                    if isinstance(info, BuildahError):
+                        continue
+                    labels = (info["OCIv1"].get("config") or {}).get("Labels") or {}
+                    self._db.executemany(
+                        "INSERT INTO labels VALUES (?, ?, ?)",
+                        [(id, k, v) for k, v in labels.items()],
+                    )
+
+                self._db.execute("DELETE FROM containers")
+                self._db.executemany(
+                    "INSERT INTO containers VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (id, _.get("containername"), _.get("imageid"), _.get("imagename"), _json.dumps(_))
+                        for id, _ in container_listings.items()
+                    ],
+                )
+                # Left out, so the next refresh inspects them again
+                retry = [id for id, info in infos.items() if isinstance(info, BuildahTransientError)]
+                self._delete("images", retry)
+            self._refreshed = _time.time()
+            self._stale = bool(retry)
+        return new, removed
+
+    def _current(self):
+        if self._stale or _time.time() - self._refreshed > self.max_age:
+            self.refresh()
+
+    def images(self, name=None, prefix=None, digest=None, labels=None, before=None, after=None):
+        """Images matching all the given criteria
+
+        `name` matches full names and tags, `prefix` the start of names or
+        ids, `labels` maps keys to values or to `None` for any value and
+        `before`/`after` are creation timestamps.
+        """
+        query, params = ["SELECT listing FROM images WHERE 1"], []
+        if name is not None:
+            query.append("AND id IN (SELECT id FROM image_names WHERE name IN (?, ?) OR repository IN (?, ?))")
+            params += [name, "localhost/" + name] * 2
+        if prefix is not None:
+            query.append("AND (id LIKE ? ESCAPE '\\' OR id IN (SELECT id FROM image_names WHERE name LIKE ? ESCAPE '\\'))")
+            pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            params += [pattern, pattern]
+        if digest is not None:
+            query.append("AND digest = ?")
+            params.append(digest)
+        for key, value in (labels or {}).items():
+            if value is None:
+                query.append("AND id IN (SELECT id FROM labels WHERE key = ?)")
+                params.append(key)
+            else:
+                query.append("AND id IN (SELECT id FROM labels WHERE key = ? AND value = ?)")
+                params += [key, value]
+        if before is not None:
+            query.append("AND created < ?")
+            params.append(before)
+        if after is not None:
+            query.append("AND created > ?")
+            params.append(after)
+
+        with self._lock:
+            self._current()
+            rows = self._db.execute(" ".join(query + ["ORDER BY created DESC"]), params).fetchall()
+        return [Image(_["id"], prefetch=False, listing=_) for _ in (_json.loads(row) for row, in rows)]
+
+    def containers(self, name=None, image=None):
+        """Containers named `name` and/or created from the image id or name `image`"""
+        query, params = ["SELECT listing FROM containers WHERE 1"], []
+        if name is not None:
+            query.append("AND name = ?")
+            params.append(name)
+        if image is not None:
+            query.append("AND (image_id = ? OR image_name = ? OR image_name = ?)")
+            params += [image, image, "localhost/" + image]
+
+        with self._lock:
+            self._current()
+            rows = self._db.execute(" ".join(query), params).fetchall()
+        return [Container(_["id"], prefetch=False, listing=_) for _ in (_json.loads(row) for row, in rows)]
+
+
+class UsageTracker:
+    """Hook remembering when images and containers were last used, for `gc()`
+
+    Keys are the names or ids the calls were made with, `save()` writes
+    them to `path` so they survive the process.
+
+        tracker = add_hook(UsageTracker())
+        atexit.register(tracker.save)
+    """
+
+    _USES = ("from", "run", "copy", "add", "config", "commit", "mount", "push", "tag")
+
+    def __init__(self, path=None):
+        self.path = path or _os.path.join(_cache_dir(), "usage.json")
+        self._lock = _threading.Lock()
+        try:
+            with open(self.path, "rt") as f:
+                self.last_used = _json.load(f)
+        except FileNotFoundError:
+            self.last_used = {}
+
+    def __call__(self, event):
+        if event["subcommand"] not in self._USES or event["returncode"] != 0 or not event["args"]:
+            return
+        with self._lock:
+            self.last_used[event["args"][0]] = event["start"]
+
+    def get(self, *names_or_ids):
+        """The last use of any of `names_or_ids`, `None` if none was seen"""
+        with self._lock:
+            uses = [self.last_used[_] for _ in names_or_ids if _ in self.last_used]
+        return max(uses, default=None)
+
+    def save(self):
+        _os.makedirs(_os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            with _tempfile.NamedTemporaryFile("wt", dir=_os.path.dirname(self.path), delete=False) as f:
+                _json.dump(self.last_used, f)
+        _os.replace(f.name, self.path)
+
+
+GCReport = _collections.namedtuple("GCReport", "removed failed reclaimed duration dry_run")
+
+
+def _remove_batches(subcommand, ids, max_workers, batch_size):
+    # Removes `ids` in calls of up to `batch_size`, a failed batch is retried
+    # one by one to tell which of them failed
+    def remove(batch):
+        if subcommand == "rm":
+            for id in batch:
+                mount_manager.forget(id)
+        try:
+            _buildah(subcommand, *batch, _capture_output=True)
+            return {}
+        except BuildahError:
+            pass
+        failed = {}
+        for id in batch:
+            try:
+                _buildah(subcommand, id, _capture_output=True)
+            except BuildahError as e:
+                failed[id] = e
+        return failed
+
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+    failed = {}
+    if batches:
+        with _futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for result in pool.map(remove, batches):
+                failed.update(result)
+    return failed
+
+
+def _image_children(infos):
+    # Maps image ids to the ids of the images built right on top of them, a
+    # parent's history and layers being where those of its children start
+    chains = {}
+    for id, info in infos.items():
+        if isinstance(info, BuildahError):
+            continue
+        history = tuple(_json.dumps(_, sort_keys=True) for _ in info["OCIv1"].get("history") or [])
+        diff_ids = tuple((info["OCIv1"].get("rootfs") or {}).get("diff_ids") or [])
+        chains[id] = (history, diff_ids)
+
+    by_history = {}
+    for id, (history, _) in chains.items():
+        by_history.setdefault(history, []).append(id)
+
+    children = {}
+    for id, (history, diff_ids) in chains.items():
+        for length in range(len(history) - 1, 0, -1):
+            parents = [
+                _ for _ in by_history.get(history[:length], [])
+                if diff_ids[:len(chains[_][1])] == chains[_][1]
+            ]
+            for parent in parents:
+                children.setdefault(parent, set()).add(id)
+            if parents:
+                break
+    return children
+
+
+def gc(
+    max_age=None,
+    max_size=None,
+    keep_labels=(),
+    usage=None,
+    dry_run=False,
+    max_workers=4,
+    batch_size=50,
+):
+    """Remove unused images and containers, returns a `GCReport`
+
+    Always removed are dangling images no container uses and working
+    containers whose image is gone. Intermediate images, like the layers
+    `bud --layers` caches (hidden unless `images --all` is asked for) and
+    images only tagged for a `StepCache`, go as well once all images built
+    on them are removed in the same run. Telling those apart inspects every
+    image, which is skipped when there are no intermediates. With `max_age`
+    (seconds), images unused for that long and, given a `UsageTracker` as
+    `usage`, containers unused for that long go too. With `max_size`
+    (bytes), the least recently used images are removed until the rest
+    fits. Images carrying any of `keep_labels` ("key" or "key=value") are
+    kept.
+
+    `removed` lists dicts with the `kind`, `id`, `names`, `reason` and
+    `size` of each removal, `failed` maps ids to their errors. `reclaimed`
+    is an estimate, an upper bound: image sizes include layers shared with
+    other images, and containers count as 0 as buildah does not know their
+    size.
+    """
+    start = _time.time()
+    image_rows = _buildah("images", _json=True) or []
+    all_rows = _buildah("images", _json=True, all=True) or []
+    image_ids = {_["id"] for _ in all_rows}
+    container_rows = _buildah("containers", _json=True, all=True) or []
+
+    def last_used(id, names, created=None):
+        used = usage.get(id, *names) if usage is not None else None
+        return max(filter(None, (used, created)), default=None)
+
+    removed = []
+    for row in container_rows:
+        if not row.get("builder"):
+            continue
+        reason = None
+        if row.get("imageid") and row["imageid"] not in image_ids:
+            reason = "orphaned"
+        elif max_age is not None and usage is not None:
+            used = last_used(row["id"], [row.get("containername")])
+            if used is not None and start - used > max_age:
+                reason = "stale"
+        if reason:
+            removed.append(dict(
+                kind="container",
+                id=row["id"],
+                names=[row.get("containername")],
+                reason=reason,
+                size=0,
+            ))
+
+    gone = {_["id"] for _ in removed}
+    in_use = {_.get("imageid") for _ in container_rows if _["id"] not in gone}
+    unused = [_ for _ in all_rows if _["id"] not in in_use and not _.get("readonly")]
+
+    visible = {_["id"] for _ in image_rows}
+    cached = StepCache.REPOSITORY + ":"
+
+    def intermediate(row):
+        names = row.get("names") or []
+        return row["id"] not in visible or (names and all(_.startswith(cached) for _ in names))
+
+    # Parents are told from the history and layers of all images
+    fields = ["OCIv1.Config.Labels"] if keep_labels else []
+    if any(intermediate(_) for _ in unused):
+        fields += ["OCIv1.History", "OCIv1.RootFS.DiffIDs"]
+        ids = [_["id"] for _ in all_rows]
+    else:
+        ids = [_["id"] for _ in unused]
+    infos = inspect_many(ids, _fields=fields, type="image") if fields and ids else {}
+    children = _image_children(infos) if "OCIv1.History" in fields else {}
+
+    if keep_labels and unused:
+        wanted = [_.partition("=") for _ in keep_labels]
+
+        def kept(row):
+            info = infos[row["id"]]
+            if isinstance(info, BuildahError):
+                return True
+            labels = (info["OCIv1"].get("config") or {}).get("Labels") or {}
+            return any(k in labels and (not sep or labels[k] == v) for k, sep, v in wanted)
+
+        unused = [_ for _ in unused if not kept(_)]
+
+    def image(row, reason):
+        return dict(
+            kind="image",
+            id=row["id"],
+            names=row.get("names") or [],
+            reason=reason,
+            size=_parse_size(row.get("size", 0)),
+            last_used=last_used(row["id"], row.get("names") or [], row.get("created")),
+        )
+
+    candidates = []
+    for row in unused:
+        if row["id"] not in visible:
+            continue
+        if not row.get("names"):
+            candidates.append(image(row, "dangling"))
+        elif max_age is not None:
+            candidate = image(row, "age")
+            if candidate["last_used"] is not None and start - candidate["last_used"] > max_age:
+                candidates.append(candidate)
+
+    if max_size is not None:
+        chosen = {_["id"] for _ in candidates}
+        total = sum(_parse_size(_.get("size", 0)) for _ in image_rows)
+        total -= sum(_["size"] for _ in candidates)
+        lru = sorted(
+            (image(_, "size") for _ in unused if _["id"] in visible and _["id"] not in chosen),
+            key=lambda _: _["last_used"] or 0,
+        )
+        for candidate in lru:
+            if total <= max_size:
+                break
+            candidates.append(candidate)
+            total -= candidate["size"]
+
+    # Going over them until none is left, so whole chains go in one run
+    removing = {_["id"] for _ in candidates}
+    pending = [_ for _ in unused if intermediate(_) and _["id"] not in removing]
+    while True:
+        ready = [_ for _ in pending if children.get(_["id"]) and children[_["id"]] <= removing]
+        if not ready:
+            break
+        for row in ready:
+            candidates.append(image(row, "intermediate"))
+            removing.add(row["id"])
+            pending.remove(row)
+
+    # Children before their parents, which buildah refuses to remove first
+    created = {_["id"]: _.get("created") or 0 for _ in all_rows}
+    candidates.sort(key=lambda _: created[_["id"]], reverse=True)
+    for candidate in candidates:
+        del candidate["last_used"]
+    removed += candidates
+
+    failed = {}
+    if not dry_run:
+        failed.update(_remove_batches(
+            "rm",
+            [_["id"] for _ in removed if _["kind"] == "container"],
+            max_workers,
+            batch_size,
+        ))
+        image_failures = _remove_batches(
+            "rmi",
+            [_["id"] for _ in removed if _["kind"] == "image"],
+            max_workers,
+            batch_size,
+        )
+        # Parents may have been tried before their children were gone
+        for id in sorted(image_failures, key=created.get, reverse=True):
+            try:
+                _buildah("rmi", id, _capture_output=True)
+            except BuildahError as e:
+                failed[id] = e
+        removed = [_ for _ in removed if _["id"] not in failed]
+
+    return GCReport(
+        removed=removed,
+        failed=failed,
+        reclaimed=sum(_["size"] for _ in removed),
+        duration=_time.time() - start,
+        dry_run=dry_run,
+    )
@@ -1,6 +1,11 @@
 # coding: utf-8
 
+import io as _io
 import os as _os
+import json as _json
+import tarfile as _tarfile
+import asyncio as _asyncio
+import concurrent.futures as _futures
 
 import faker as _faker
 import pytest as _pytest
@@ -44,6 +49,25 @@ def test_containers():
         assert actual.name
 
 
+def test_images_lazy():
+    for actual in _buildah.images():
+        assert actual.id
+        assert actual.digest
+        assert actual.created
+        assert actual._info is None
+
+    for actual in _buildah.images(_prefetch=True):
+        assert actual._info is not None
+
+
+def test_containers_lazy(container):
+    actual = [_ for _ in _buildah.containers() if _.id == container.id][0]
+    assert actual.name == container.name
+    assert actual._info is None
+    assert actual.cmd == ["/bin/sh"]
+    assert actual._info is not None
+
+
 def test_inspect_container(container):
     actual = _buildah.inspect(container.id, type="container")
     assert "Type" in actual
@@ -312,3 +336,653 @@ def test_container_config(container):
     container.labels = wanted
     container.refresh()
     assert wanted == container.labels
+
+
+def test_container_transaction(container):
+    with container.transaction():
+        container.user = "nobody"
+        container.env["foo"] = "bar"
+        container.env["foo"] = "baz"
+        container.labels["one"] = "two"
+        container.volumes.add("/tmp/foo")
+        container.volumes.discard("/tmp/foo")
+        container.volumes.add("/tmp/bar")
+        assert container.env["foo"] == "baz"
+        assert container.inspect()["OCIv1"]["config"]["User"] != "nobody"
+
+    info = container.inspect()
+    assert info["OCIv1"]["config"]["User"] == "nobody"
+    assert "foo=baz" in info["OCIv1"]["config"]["Env"]
+    assert info["OCIv1"]["config"]["Labels"] == {"one": "two"}
+    assert set(info["OCIv1"]["config"]["Volumes"]) == {"/tmp/bar"}
+
+
+def test_async_container():
+    async def build():
+        container = await _buildah.async_from_("alpine:3.12", name=fake_name())
+        try:
+            async with container.transaction():
+                container.user = "nobody"
+            actual = await container.run(["echo", "-n", "foo"], _capture_output=True)
+            info = await container.inspect()
+        finally:
+            await container.rm()
+        return actual, info
+
+    actual, info = _asyncio.run(build())
+    assert actual == "foo"
+    assert info["OCIv1"]["config"]["User"] == "nobody"
+
+
+def test_async_container_add():
+    async def build():
+        container = await _buildah.async_from_("alpine:3.12", name=fake_name())
+        try:
+            await container.add_contents(b"foo", "/tmp/foo")
+            await container.add_files({"/tmp/bar": b"bar"})
+            return await container.run_many(["cat /tmp/foo", "cat /tmp/bar"])
+        finally:
+            await container.rm()
+
+    actual = _asyncio.run(build())
+    assert [_.stdout for _ in actual] == ["foo", "bar"]
+
+
+def test_async_container_fs():
+    async def build():
+        container = await _buildah.async_from_("alpine:3.12", name=fake_name())
+        try:
+            container.fs.write_bytes("/tmp/foo", b"foo")
+            return container.fs.exists("/etc"), container.fs.read_bytes("/tmp/foo")
+        finally:
+            await container.rm()
+
+    assert _asyncio.run(build()) == (True, b"foo")
+
+
+def test_async_limit():
+    _buildah.set_async_limit(2)
+
+    async def inspect_all():
+        return await _asyncio.gather(*[_buildah.async_inspect(_.id) for _ in _buildah.images()])
+
+    try:
+        actual = _asyncio.run(inspect_all())
+    finally:
+        _buildah.set_async_limit(_os.cpu_count() or 4)
+    assert all("Type" in _ for _ in actual)
+
+
+def test_inspect_many(container):
+    missing = fake_name()
+    actual = _buildah.inspect_many([container.id, missing], type="container", max_workers=2)
+    assert actual[container.id]["ContainerID"] == container.id
+    assert isinstance(actual[missing], _buildah.BuildahNotFound)
+
+
+def test_refresh_all(container):
+    missing = _buildah.Container(container.id, prefetch=False)
+    missing._name_or_id = fake_name()
+    found = [_ for _ in _buildah.containers() if _.id == container.id][0]
+    assert found.user == ""
+    _buildah.config(container.id, user="nobody")
+    actual = _buildah.Inspectable.refresh_all([found, missing])
+    assert actual == [missing]
+    assert found._info["ContainerID"] == container.id
+    assert found.user == "nobody"
+
+
+def test_inspect_fields(container):
+    actual = _buildah.inspect(container.id, type="container", _fields=["ContainerID", "Config"])
+    assert set(actual) == {"ContainerID", "Config"}
+    assert actual["ContainerID"] == container.id
+    assert actual["Config"]["os"] == "linux"
+
+
+def test_inspect_lazy(container):
+    info = _buildah.inspect(container.id, type="container")
+    assert _json.loads(_json.dumps(info))["Config"]["os"] == "linux"
+    assert dict(_buildah.inspect(container.id, type="container"))["Config"]["os"] == "linux"
+
+
+def test_container_projection(container):
+    container.user = "nobody"
+    events = []
+    hook = _buildah.add_hook(events.append)
+    try:
+        actual = _buildah.Container(container.id, projection=True)
+        assert actual.user == "nobody"
+        assert actual.cmd == ["/bin/sh"]
+        assert "PATH" in actual.env
+        assert actual.arch and actual.os == "linux"
+    finally:
+        _buildah.remove_hook(hook)
+    assert [_["subcommand"] for _ in events] == ["inspect"]
+    assert actual._info is None
+
+
+@_pytest.fixture
+def inspect_cache():
+    _buildah.inspect_cache.ttl = 60
+    yield _buildah.inspect_cache
+    _buildah.inspect_cache.ttl = 0
+    _buildah.inspect_cache.clear()
+
+
+def test_inspect_cache(container, inspect_cache):
+    first = _buildah.Container(container.id)
+    hits = inspect_cache.hits
+    second = _buildah.Container(container.id)
+    assert inspect_cache.hits == hits + 1
+    assert first.info is second.info
+
+    first.user = "nobody"
+    assert second.user == "nobody"
+
+
+def test_inspect_cache_rm(inspect_cache):
+    container = _buildah.from_("alpine:3.12", name=fake_name())
+    _buildah.inspect(container.id, type="container")
+    _buildah.rm(container.id)
+    with _pytest.raises(_buildah.BuildahNotFound):
+        _buildah.inspect(container.id, type="container")
+
+
+def test_inspect_cache_run(container, inspect_cache):
+    events = []
+    hook = _buildah.add_hook(events.append)
+    try:
+        for _ in range(3):
+            container.run("true")
+    finally:
+        _buildah.remove_hook(hook)
+    assert [_["subcommand"] for _ in events] == ["run"] * 3
+
+
+def test_inspect_cache_async(inspect_cache):
+    async def build():
+        container = await _buildah.async_from_("alpine:3.12", name=fake_name())
+        try:
+            await container.run("true")
+            await container.run("true")
+            async with container.transaction():
+                container.user = "nobody"
+            assert container.user == "nobody"
+            assert container.fs.exists("/etc")
+            await container.refresh()
+            return container.user
+        finally:
+            await container.rm()
+
+    assert _asyncio.run(build()) == "nobody"
+
+
+def test_inspect_cache_by_name(inspect_cache):
+    container = _buildah.from_("alpine:3.12", name=fake_name())
+    _buildah.inspect(container.id, type="container")
+    _buildah.config(container.name, user="nobody")
+    assert inspect_cache.get(container.id, "container") is None
+    _buildah.inspect(container.id, type="container")
+    _buildah.rm(container.name)
+    with _pytest.raises(_buildah.BuildahNotFound):
+        _buildah.inspect(container.id, type="container")
+
+
+def test_hooks(container, tmpdir):
+    path = str(tmpdir.join("events.jsonl"))
+    sink = _buildah.add_hook(_buildah.JSONLSink(path))
+    histogram = _buildah.add_hook(_buildah.Histogram())
+    try:
+        container.run(["echo", "-n", "foo"], _capture_output=True)
+    finally:
+        _buildah.remove_hook(sink)
+        _buildah.remove_hook(histogram)
+        sink.close()
+
+    event = _json.loads(open(path).readline())
+    assert event["subcommand"] == "run"
+    assert event["stdout_bytes"] == 3
+    assert event["returncode"] == 0
+    assert event["max_rss"] > 0
+    assert histogram.summary()["run"]["count"] == 1
+
+
+def test_run_stream(container):
+    actual = list(container.run("echo foo; echo bar >&2; echo baz", _stream=True))
+    assert [_ for _ in actual if _[0] == "stdout"] == [("stdout", "foo\n"), ("stdout", "baz\n")]
+    assert ("stderr", "bar\n") in actual
+
+
+def test_run_stream_binary(container):
+    actual = b"".join(
+        data
+        for name, data in container.run(["printf", "\\377foo"], _stream=True, _binary=True)
+        if name == "stdout"
+    )
+    assert actual == b"\xfffoo"
+
+
+def test_run_sink(container, tmpdir):
+    f = tmpdir.join("output")
+    with open(str(f), "wb") as sink:
+        assert container.run(["seq", "1", "3"], _sink=sink, _binary=True) is None
+    assert f.read() == "1\n2\n3\n"
+
+
+def test_run_stream_error(container):
+    with _pytest.raises(_buildah.BuildahError) as e:
+        list(container.run("echo broken >&2; exit 1", _stream=True))
+    assert "broken" in str(e.value)
+
+
+def test_cached_build(tmpdir):
+    cache = _buildah.StepCache(str(tmpdir.join("steps.json")))
+    f = tmpdir.join("test")
+    f.write("foo")
+
+    images = []
+    for _ in range(2):
+        build = _buildah.CachedBuild("alpine:3.12", cache=cache)
+        build.run("echo foo > /foo").copy(str(f), "/tmp/test").config(user="nobody")
+        images.append(build.commit(fake_name()))
+
+    assert build.hits == 3
+    assert build.misses == 0
+    assert images[0].id == images[1].id
+
+    f.write("bar")
+    build = _buildah.CachedBuild("alpine:3.12", cache=cache)
+    build.run("echo foo > /foo").copy(str(f), "/tmp/test")
+    assert [_["hit"] for _ in build.report] == [True, False]
+    build.commit(fake_name())
+
+    assert len(cache.evict(max_age=0)) == 4
+
+
+def test_step_cache_shared(tmpdir):
+    path = str(tmpdir.join("steps.json"))
+    first, second = _buildah.StepCache(path), _buildah.StepCache(path)
+    first.put("a", "image-a", "parent")
+    second.put("b", "image-b", "parent")
+    first.put("c", "image-c", "parent")
+    assert set(_buildah.StepCache(path)._index) == {"a", "b", "c"}
+
+
+def test_container_add_files(container, tmpdir):
+    f = tmpdir.join("test")
+    f.write("baz")
+    with open(str(f), "rb") as fileobj:
+        container.add_files({
+            "/tmp/foo": b"foo",
+            "tmp/sub/bar": (b"bar", 0o700, 65534, 65534),
+            "/tmp/baz": fileobj,
+        })
+
+    assert container.run("cat /tmp/foo /tmp/sub/bar /tmp/baz", _capture_output=True) == "foobarbaz"
+    actual = container.run("stat -c '%a %u %g' /tmp/sub/bar", _capture_output=True)
+    assert actual.strip() == "700 65534 65534"
+
+
+def test_container_fs(container, tmpdir):
+    fs = container.fs
+    fs.write_bytes("/tmp/foo", b"foo", mode=0o600)
+    assert fs.read_bytes("/tmp/foo") == b"foo"
+    assert fs.exists("/tmp/foo")
+    assert not fs.exists("/tmp/nope")
+    assert fs.stat("/tmp/foo").st_mode & 0o777 == 0o600
+    assert "foo" in fs.listdir("/tmp")
+    assert container.run("cat /tmp/foo", _capture_output=True) == "foo"
+
+    with fs.open("/tmp/foo", "a") as f:
+        f.write("bar")
+    assert fs.read_text("/tmp/foo") == "foobar"
+
+    walked = {path: files for path, dirs, files in fs.walk("/tmp")}
+    assert "foo" in walked["/tmp"]
+
+    # Absolute links resolve within the container, not on the host
+    container.run("ln -s /tmp/foo /tmp/link")
+    assert fs.read_bytes("/tmp/link") == b"foobar"
+    container.run("ln -s /tmp/nope /tmp/dangling")
+    assert not fs.exists("/tmp/dangling")
+
+    f = tmpdir.join("test")
+    f.write("baz")
+    fs.copy_in(str(f), "/tmp/baz")
+    fs.copy_out("/tmp/baz", str(tmpdir.join("out")))
+    assert tmpdir.join("out").read() == "baz"
+
+
+def test_container_fs_fallback(container):
+    fs = container.fs
+    fs._mountable = False
+    fs.write_bytes("/tmp/foo", b"foo", mode=0o600)
+    assert fs.read_bytes("/tmp/foo") == b"foo"
+    assert fs.exists("/tmp/foo")
+    container.run("ln -s /tmp/nope /tmp/dangling")
+    assert not fs.exists("/tmp/dangling")
+    assert fs.stat("/tmp/foo").st_mode & 0o777 == 0o600
+    assert "foo" in fs.listdir("/tmp")
+    walked = {path: files for path, dirs, files in fs.walk("/tmp")}
+    assert "foo" in walked["/tmp"]
+
+
+def test_container_mount_reuse(container):
+    with container.mount() as first:
+        with container.mount() as nested:
+            assert first == nested
+    assert container.id in _buildah.mount()
+
+    with _pytest.raises(ValueError):
+        with container.mount() as again:
+            assert again == first
+            raise ValueError()
+
+    _buildah.mount_manager.flush()
+    assert container.id not in _buildah.mount()
+
+
+def test_container_mount_after_umount(container):
+    for umount in (lambda: _buildah.umount(container.name), lambda: _buildah.umount(all=True)):
+        with container.mount():
+            pass
+        umount()
+        with container.mount():
+            assert container.id in _buildah.mount()
+
+
+def test_container_run_many(container):
+    actual = container.run_many([
+        ["echo", "-n", "foo"],
+        "echo -n bar >&2",
+        "exit 3",
+        "echo never",
+    ])
+    assert [_.returncode for _ in actual] == [0, 0, 3]
+    assert actual[0].stdout == "foo"
+    assert actual[1].stderr == "bar"
+    assert actual[0].cmd == ["echo", "-n", "foo"]
+
+    actual = container.run_many(["exit 1", "echo -n foo"], stop_on_error=False)
+    assert [_.returncode for _ in actual] == [1, 0]
+    assert actual[1].stdout == "foo"
+
+
+def test_unshare_worker(container):
+    worker = _buildah.unshare(worker=True)
+    if worker is None:
+        _pytest.skip("Already running within buildah unshare")
+    try:
+        assert container.run(["echo", "-n", "foo"], _capture_output=True) == "foo"
+        assert _buildah.inspect(container.id)["ContainerID"] == container.id
+        container.fs.write_bytes("/tmp/foo", b"foo")
+        assert container.fs.read_bytes("/tmp/foo") == b"foo"
+    finally:
+        worker.close()
+    assert _buildah._worker is None
+
+
+def test_build_graph():
+    tag = fake_name()
+    graph = _buildah.BuildGraph(parallelism=2)
+    graph.stage("a", "alpine", lambda c: c.run("sh -c 'echo a > /a'"))
+    graph.stage("b", "alpine", lambda c: c.run("sh -c 'echo b > /b'"))
+    graph.stage("final", "alpine", artifacts=[("a", "/a", "/a"), ("b", "/b", "/b")], commit=tag)
+    result = graph.build()
+    try:
+        assert set(result.images) == {"final"}
+        assert set(result.timings) == {"a", "b", "final"}
+        assert result.critical_path[0][-1] == "final"
+        assert len(result.critical_path[0]) == 2
+        container = _buildah.from_(tag)
+        try:
+            assert container.run("cat /a /b", _capture_output=True) == "a\nb\n"
+        finally:
+            container.rm()
+    finally:
+        result.images["final"].rm()
+
+
+def test_build_graph_failure():
+    before = {_.id for _ in _buildah.containers()}
+    graph = _buildah.BuildGraph()
+    graph.stage("a", "alpine", lambda c: c.run("false"))
+    graph.stage("b", "alpine", depends=["a"])
+    with _pytest.raises(_buildah.BuildahError):
+        graph.build()
+    assert {_.id for _ in _buildah.containers()} == before
+
+    graph = _buildah.BuildGraph()
+    graph.stage("a", "alpine", depends=["b"])
+    graph.stage("b", "alpine", depends=["a"])
+    with _pytest.raises(ValueError):
+        graph.build()
+
+
+def test_build_platforms_manifest():
+    name = fake_name()
+    images = _buildah.build_platforms(
+        "alpine",
+        lambda c: c.run("true"),
+        ["linux/amd64", "linux/arm64"],
+        name,
+    )
+    try:
+        actual = [_buildah.inspect(_.id, type="image")["OCIv1"]["architecture"] for _ in images.values()]
+        assert actual == ["amd64", "arm64"]
+        manifest = _buildah.Manifest.create(name, *images.values())
+        try:
+            actual = manifest.inspect()
+            assert sorted(_["platform"]["architecture"] for _ in actual["manifests"]) == ["amd64", "arm64"]
+        finally:
+            manifest.rm()
+    finally:
+        for image in images.values():
+            image.rm()
+
+
+def test_transfer_manager_pull():
+    transfers = _buildah.TransferManager(policy="always")
+    with _futures.ThreadPoolExecutor(max_workers=4) as pool:
+        actual = list(pool.map(transfers.pull, ["alpine"] * 4))
+    assert len({_.id for _ in actual}) == 1
+    assert sum(not _["shared"] for _ in transfers.transfers) >= 1
+    assert all(_["op"] == "pull" and _["duration"] >= 0 for _ in transfers.transfers)
+
+    transfers = _buildah.TransferManager(policy="missing")
+    transfers.pull("alpine")
+    assert transfers.transfers[0]["skipped"]
+    assert transfers.transfers[0]["bytes"] > 0
+
+
+def test_transfer_manager_push(tmp_path):
+    transfers = _buildah.TransferManager()
+    destinations = ["dir:{}".format(tmp_path / str(i)) for i in range(3)]
+    actual = transfers.push("alpine", destinations + ["docker://localhost:1/nowhere"])
+    assert [actual[_] for _ in destinations] == [None] * 3
+    assert isinstance(actual["docker://localhost:1/nowhere"], _buildah.BuildahError)
+    assert sorted(_["destination"] for _ in transfers.transfers)[:3] == destinations
+    assert sorted(_.name for _ in tmp_path.iterdir()) == ["0", "1", "2"]
+
+
+def test_container_pool():
+    pool = _buildah.ContainerPool("alpine:3.12", size=1)
+    try:
+        with pool.container() as container:
+            clean = container.id
+        with pool.container() as container:
+            assert container.id == clean
+            container.run("touch /tmp/foo")
+        with pool.container() as container:
+            assert container.id != clean
+        assert pool.hits + pool.misses == 3
+        assert pool.wait_time >= 0
+        late = pool.acquire()
+    finally:
+        pool.close()
+    pool.release(late)
+    remaining = {_.id for _ in _buildah.containers()}
+    assert clean not in remaining
+    assert late.id not in remaining
+
+
+def test_index(tmp_path, container):
+    index = _buildah.Index(path=str(tmp_path / "index.sqlite"))
+    try:
+        container.labels["python-buildah-test"] = "index"
+        name = fake_name()
+        image = container.commit(name)
+        actual = index.images(labels={"python-buildah-test": "index"})
+        assert [_.id for _ in actual] == [image.id]
+        assert [_.id for _ in index.images(name=name)] == [image.id]
+        assert [_.id for _ in index.images(prefix=image.id[:12])] == [image.id]
+        assert container.id in [_.id for _ in index.containers(name=container.name)]
+
+        image.rm()
+        assert index.images(name=name) == []
+    finally:
+        index.close()
+
+
+def test_recorder(tmp_path):
+    (tmp_path / "foo").write_text("foo")
+    recorder = _buildah.Recorder("alpine:3.12")
+    try:
+        recorder.run("echo -n bar > /bar")
+        recorder.copy(str(tmp_path / "foo"), "/foo")
+        recorder.env["FOO"] = "foo"
+        recorder.env["LITERAL"] = "$HOME \\"
+        recorder.cmd = ["cat", "/foo"]
+        text, count = recorder.containerfile()
+        assert count == 5
+        assert 'ENV FOO="foo"' in text
+
+        image = recorder.commit(fake_name())
+        try:
+            container = _buildah.from_(image.id)
+            try:
+                assert container.env["FOO"] == "foo"
+                assert container.env["LITERAL"] == "$HOME \\"
+                assert container.cmd == ["cat", "/foo"]
+                assert container.run("cat /foo /bar", _capture_output=True) == "foobar"
+            finally:
+                container.rm()
+        finally:
+            image.rm()
+
+        # Removing a variable has no Containerfile equivalent
+        recorder.env["FOO"] = None
+        assert recorder.containerfile()[1] == 5
+        dangling = {_.id for _ in _buildah.images(filter="dangling=true")}
+        image = recorder.commit(fake_name())
+        assert {_.id for _ in _buildah.images(filter="dangling=true")} <= dangling
+        try:
+            container = _buildah.from_(image.id)
+            try:
+                assert "FOO" not in container.env
+            finally:
+                container.rm()
+        finally:
+            image.rm()
+    finally:
+        recorder.rm()
+
+
+def test_gc_dry_run(container):
+    container.labels["python-buildah-test"] = "gc"
+    kept = container.commit(fake_name())
+    container.labels["python-buildah-test"] = "other"
+    image = container.commit(fake_name())
+    try:
+        report = _buildah.gc(max_age=0, keep_labels=["python-buildah-test=gc"], dry_run=True)
+        removed = {_["id"]: _ for _ in report.removed}
+        assert removed[image.id]["reason"] == "age"
+        assert removed[image.id]["size"] > 0
+        assert kept.id not in removed
+        assert report.reclaimed >= removed[image.id]["size"]
+        assert report.dry_run and not report.failed
+        assert image.id in {_.id for _ in _buildah.images()}
+    finally:
+        image.rm()
+        kept.rm()
+
+
+def test_gc_intermediates(tmp_path):
+    tmp_path.joinpath("Containerfile").write_text("FROM alpine:3.12\nRUN touch /a\nRUN touch /b\n")
+    image = _buildah.bud(str(tmp_path))
+    report = _buildah.gc(dry_run=True)
+    reasons = {_["id"]: _["reason"] for _ in report.removed}
+    try:
+        assert reasons[image.id] == "dangling"
+        assert "intermediate" in reasons.values()
+    finally:
+        for id, reason in reasons.items():
+            if id == image.id or reason == "intermediate":
+                _buildah.rmi(id)
+
+
+@_pytest.mark.parametrize("compression", [None, "gzip"])
+def test_container_export(container, compression):
+    reports = []
+    f = _io.BytesIO()
+    actual = container.export(f, compression=compression, threads=2, progress=reports.append)
+    assert reports[-1] == actual
+    assert actual["written"] == len(f.getvalue())
+    assert actual["files"] > 0
+
+    f.seek(0)
+    with _tarfile.open(fileobj=f, mode="r|*") as tar:
+        names = [_.name for _ in tar]
+    assert "etc/alpine-release" in names
+    assert len(names) == actual["files"]
+
+
+def test_transient_errors():
+    assert isinstance(_buildah._error("resource temporarily unavailable"), _buildah.BuildahLockError)
+    assert isinstance(_buildah._error("container foo is in use"), _buildah.BuildahInUseError)
+    assert type(_buildah._error("something else")) is _buildah.BuildahError
+    assert type(_buildah._error("image is in use by a container")) is _buildah.BuildahError
+
+
+def test_scheduler():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise _buildah.BuildahLockError("database is locked")
+        return "done"
+
+    order = []
+    with _buildah.Scheduler(max_workers=4, backoff=0.001) as scheduler:
+        flaky = scheduler.submit("flaky", flaky)
+        futures = [scheduler.submit(key, order.append, (key, i)) for i in range(5) for key in "ab"]
+        assert flaky.result() == "done"
+        for future in futures:
+            future.result()
+        stats = scheduler.stats()
+
+    assert [i for key, i in order if key == "a"] == list(range(5))
+    assert stats["operations"] == 11
+    assert stats["retries"] == 2
+    assert stats["wait_time"] >= 0 and stats["exec_time"] > 0
+
+
+def test_container_sync(container, tmp_path):
+    source = tmp_path / "src"
+    (source / "sub").mkdir(parents=True)
+    (source / "foo").write_text("foo")
+    (source / "sub" / "bar").write_text("bar")
+
+    actual = container.sync(str(source), "/app")
+    assert (actual["added"], actual["skipped"], actual["bytes"]) == (2, 0, 6)
+
+    actual = container.sync(str(source), "/app")
+    assert (actual["added"], actual["changed"], actual["skipped"]) == (0, 0, 2)
+
+    (source / "foo").write_text("changed")
+    (source / "sub" / "bar").unlink()
+    actual = container.sync(str(source), "/app")
+    assert (actual["changed"], actual["deleted"], actual["skipped"]) == (1, 1, 0)
+    assert container.fs.read_text("/app/foo") == "changed"
+    assert not container.fs.exists("/app/sub/bar")